@@ -1,4 +1,5 @@
 import streamlit as st
+from utils.prewarm import start_prewarm, prewarm_status
 
 st.set_page_config(
     page_title="Supermarket Analysis Dashboard",
@@ -11,6 +12,7 @@ st.logo(
     st.secrets["LOGO"],
     icon_image=st.secrets["ICON"],
 )
+start_prewarm()
 
 col1, col2 = st.columns(2)
 with col1:
@@ -32,6 +34,9 @@ with col2:
         st.page_link("pages/AI_Chat_Bot.py", label="AI Chat Bot", icon="🤖", use_container_width=True)
         st.markdown("This page is not available for online demonstration at the moment. Star this page and get notified when a possible fix is patched. Thank you: Interact with the AI chatbot for understanding your data.")
 
+with st.expander("Data refresh status"):
+    st.dataframe(prewarm_status(), hide_index=True)
+
 #st.sidebar.title("Navigation")
 #page = st.sidebar.selectbox("Choose a Dashboard", ["Sales Trend Analysis"])
 
@@ -0,0 +1,66 @@
+# benchmark_chat_model.py
+# Loads the chat model the way the AI Chat Bot page does (or with the given
+# overrides) and reports load time, generation speed in tokens/sec and the
+# peak resident memory of the process.
+# With --concurrent N it also sends N prompts at once through the micro-batching
+# queue and reports their combined throughput.
+# Usage: python benchmark_chat_model.py [--device cpu|cuda|auto] [--no-quantize] [--threads N] [--runs N] [--concurrent N]
+import argparse
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.chat_batching import ChatBatcher
+from utils.chat_model import CHAT_DEVICE, CHAT_QUANTIZE, CHAT_THREADS, CHAT_MAX_NEW_TOKENS, build_chat_model, generate_tokens
+
+PROMPTS = [
+    "Can you summarize last month's sales?",
+    "Which products sell best on weekends?",
+    "How can we increase repeat purchases from our top customers?",
+    "What trends do you see in customer spending over the year?",
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', default=CHAT_DEVICE)
+parser.add_argument('--no-quantize', dest='quantize', action='store_false', default=CHAT_QUANTIZE)
+parser.add_argument('--threads', type=int, default=CHAT_THREADS)
+parser.add_argument('--runs', type=int, default=len(PROMPTS))
+parser.add_argument('--max-new-tokens', type=int, default=CHAT_MAX_NEW_TOKENS)
+parser.add_argument('--concurrent', type=int, default=0)
+args = parser.parse_args()
+
+chat_model = build_chat_model(device=args.device, quantize=args.quantize, threads=args.threads)
+print(f"Loaded in {chat_model['load_seconds']:.1f}s on {chat_model['device']} "
+      f"(quantized: {chat_model['quantized']}, threads: {chat_model['threads']}, "
+      f"cached context tokens: {0 if chat_model['prefix_ids'] is None else chat_model['prefix_ids'].shape[1]})")
+
+# The first generation pays one-off costs (allocator, kernel selection), keep it out of the timings
+generate_tokens(chat_model, PROMPTS[0], max_new_tokens=4)
+
+total_tokens, total_seconds = 0, 0.0
+print(f"\n{'Prompt':<62}{'Tokens':>8}{'Seconds':>10}{'Tokens/sec':>12}")
+for run in range(args.runs):
+    prompt = PROMPTS[run % len(PROMPTS)]
+    start = time.perf_counter()
+    tokens = generate_tokens(chat_model, prompt, max_new_tokens=args.max_new_tokens).shape[1]
+    seconds = time.perf_counter() - start
+    total_tokens += tokens
+    total_seconds += seconds
+    print(f"{prompt[:60]:<62}{tokens:>8}{seconds:>10.2f}{tokens / seconds:>12.2f}")
+print(f"\nSequential: {total_tokens / total_seconds:.2f} tokens/sec")
+
+if args.concurrent:
+    batcher = ChatBatcher(chat_model, max_batch=args.concurrent, max_new_tokens=args.max_new_tokens)
+    tokenizer = chat_model['tokenizer']
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(args.concurrent)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrent) as executor:
+        responses = list(executor.map(lambda prompt: ''.join(batcher.stream(prompt)), prompts))
+    seconds = time.perf_counter() - start
+    # Token count of the decoded responses, close to the number generated
+    tokens = sum(len(tokenizer(response, add_special_tokens=False)['input_ids']) for response in responses)
+    print(f"{args.concurrent} concurrent prompts: {tokens / seconds:.2f} tokens/sec in {seconds:.2f}s, "
+          f"batch sizes {list(batcher.batch_sizes)}")
+
+# ru_maxrss is in kilobytes on Linux
+peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(f"Peak RSS {peak_rss_mb:,.0f} MB")
@@ -0,0 +1,51 @@
+# benchmark_recommenders.py
+# Compares the dense cosine matrix, the sparse TF-IDF similarity, the
+# collaborative filtering model and the LSH index on memory footprint and
+# query latency, and reports the LSH index's recall against exact cosine.
+# Usage: python benchmark_recommenders.py [number of queries]
+import sys
+import time
+import numpy as np
+from utils.models import get_recommendations, get_similarity, get_ann_index
+from utils.ann import recall_report
+from utils.collaborative import get_collaborative_similarity
+from utils.recommendations import fetch_products
+
+def sparse_nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+def time_queries(product_ids, products, cosine_sim):
+    start = time.perf_counter()
+    for product_id in product_ids:
+        get_recommendations(product_id, products, cosine_sim=cosine_sim)
+    return (time.perf_counter() - start) / len(product_ids) * 1000
+
+n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+print("Fetching products...")
+products = fetch_products()
+print(f"Fetched {len(products)} products.")
+
+print("Building models...")
+tfidf_sim = get_similarity(products[['productno', 'description']])
+dense_sim = (tfidf_sim.tfidf_matrix @ tfidf_sim.tfidf_matrix.T).toarray()
+cf_sim = get_collaborative_similarity(products['productno'])
+ann_index = get_ann_index(products[['productno', 'description']])
+
+rng = np.random.default_rng(0)
+product_ids = rng.choice(products['productno'].to_numpy(), size=min(n_queries, len(products)), replace=False)
+
+results = [
+    ("Dense cosine (N x N)", dense_sim.nbytes, time_queries(product_ids, products, dense_sim)),
+    ("Sparse TF-IDF, on demand", sparse_nbytes(tfidf_sim.tfidf_matrix), time_queries(product_ids, products, tfidf_sim)),
+    ("Collaborative (co-purchase)", cf_sim.nbytes(), time_queries(product_ids, products, cf_sim)),
+    ("LSH approximate (TF-IDF)", ann_index.sorted_codes.nbytes + ann_index.order.nbytes + ann_index.planes.nbytes, time_queries(product_ids, products, ann_index)),
+]
+
+print(f"\n{'Model':<30}{'Memory (MB)':>14}{'Latency (ms/query)':>22}")
+for name, nbytes, latency in results:
+    print(f"{name:<30}{nbytes / 1e6:>14.2f}{latency:>22.2f}")
+
+report = recall_report(ann_index, sample=n_queries)
+print(f"\nLSH index ({report['n_tables']} tables, {report['n_bits']} bits, {report['probes']} probes): "
+      f"recall@10 {report['recall']:.3f}, {report['ann_ms_per_query']:.2f} ms/query vs {report['exact_ms_per_query']:.2f} ms exact")
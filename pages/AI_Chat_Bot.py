@@ -1,28 +1,18 @@
 import streamlit as st
-import torch
-from peft import AutoPeftModelForCausalLM
-from transformers import AutoTokenizer
+from utils.chat_model import load_chat_model, chat_model_metrics, stream_response
+from utils.chat_batching import CHAT_BATCHING, get_chat_batcher
 
 st.set_page_config(
     page_title="AI: Chatting...",
     page_icon=st.secrets["FAVICON"],
     layout="wide",
 )
-# Hugging Face model and tokenizer
-MODEL_PATH = st.secrets["MODEL_PATH"]
-
-# Ensure the model path and all required files are present
+# Loaded once per process, later reruns and sessions reuse it
 try:
-    load_in_4bit = True  # Adjust based on your setup
-
-    # Load the model and tokenizer using peft
-    model = AutoPeftModelForCausalLM.from_pretrained(
-        MODEL_PATH, 
-        load_in_4bit=load_in_4bit
-    )
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+    chat_model = load_chat_model()
 except Exception as e:
     st.error(f"Error loading model or tokenizer: {e}")
+    st.stop()
 
 st.title("AI Chat Bot")
 st.image(st.secrets["LOGO"], width=100)
@@ -41,36 +31,19 @@ def clear_chat_history():
     st.session_state.messages = [{"role": "assistant", "content": "How may I assist you today?"}]
 st.sidebar.button('Clear Chat History', on_click=clear_chat_history)
 
-# Function for generating responses
-def generate_response(prompt_input):
-    # Include a detailed context in the prompt
-    context = (
-        "You are a data analysis assistant specializing in sales data for a supermarket in a hotel. "
-        "Your responses should be relevant to sales data analysis, customer trends, "
-        "and provide insightful information. Avoid providing unrelated information. "
-        "Answer in a concise and professional manner.\n\n"
-        "Example:\n"
-        "User: Can you provide an analysis of our monthly sales trends?\n"
-        "Assistant: Certainly! Based on the sales data from the past six months, we see a steady increase in sales volume, with a peak in December. The most popular product during this period was the Galaxy S4, accounting for 30% of total sales.\n\n"
-        "User: "
-    )
-    
-    # Concatenate the context with the user's input
-    full_prompt = f"{context} {prompt_input} \nAssistant:"
-
-    # Prepare inputs and generate response
-    inputs = tokenizer([full_prompt], return_tensors="pt")
-    if torch.cuda.is_available():
-        inputs = inputs.to("cuda")
-        model = model.to("cuda")
-    outputs = model.generate(**inputs, max_new_tokens=64, use_cache=True)
-    response = tokenizer.batch_decode(outputs, skip_special_tokens=True)[0]
-    
-    # Remove the context part from the response
-    response = response.replace(context, "").strip()
-    response = response.replace(prompt_input, "").strip()
-    
-    return response
+with st.sidebar.expander("Model metrics"):
+    metrics = chat_model_metrics(chat_model)
+    st.write(f"Device: {metrics['device']}, int8: {metrics['quantized']}, threads: {metrics['threads']}")
+    st.write(f"Cached context: {metrics['prefix_tokens']} tokens")
+    st.metric("Load time", f"{metrics['load_seconds']:.1f} s")
+    st.metric("Model size", f"{metrics['model_mb']:,.0f} MB")
+    st.metric("Process memory", f"{metrics['process_rss_mb']:,.0f} MB")
+    if 'ttft_last_seconds' in metrics:
+        st.metric("Time to first token", f"{metrics['ttft_last_seconds']:.2f} s",
+                  delta=f"median {metrics['ttft_median_seconds']:.2f} s", delta_color="off")
+    if CHAT_BATCHING and get_chat_batcher().batch_sizes:
+        batch_sizes = get_chat_batcher().batch_sizes
+        st.metric("Average batch size", f"{sum(batch_sizes) / len(batch_sizes):.1f}")
 
 # User-provided prompt
 if prompt := st.chat_input():
@@ -78,8 +51,14 @@ if prompt := st.chat_input():
     with st.chat_message("user"):
         st.write(prompt)
 
+    # Tokens are written as they are generated, instead of behind a spinner until the whole answer is ready.
+    # With batching the prompt is generated together with other sessions' prompts.
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            response = generate_response(prompt)
-            st.write(response)
-    st.session_state.messages.append({"role": "assistant", "content": response})
+        stream = get_chat_batcher().stream(prompt) if CHAT_BATCHING else stream_response(chat_model, prompt)
+        try:
+            response = st.write_stream(stream).strip()
+        except Exception as e:
+            st.error(f"Error generating a response: {e}")
+            response = None
+    if response is not None:
+        st.session_state.messages.append({"role": "assistant", "content": response})
@@ -1,274 +1,138 @@
 import streamlit as st
 import pandas as pd
-from utils.database import fetch_data
+from utils.cache import result_cache
+from utils.database import fetch_prepared
+from utils.customer_metrics import CUSTOMER_METRICS_TTL, load_customer_metrics, get_purchasing_customers
+from utils.customer_search import build_customer_labels
+from utils.dashboard_queries import get_top_10_items
+from utils.prewarm import start_prewarm
 from utils.models import get_recommendations
+from utils.recommendations import fetch_products, get_customer_recommendations
 import joblib
 
 # Function to fetch all customer data including total amount spent and top purchases
-@st.cache_data
 def get_all_customer_data():
-    query = """
-    WITH customer_payment_totals AS (
-        SELECT
-            pay.phone,
-            c.cname AS customer_name,
-            COUNT(DISTINCT pay.paymentid) AS total_payments,
-            SUM(pay.amount) AS total_paid,
-            MIN(pay.datein) AS first_payment_date,
-            MAX(pay.datein) AS last_payment_date
-        FROM
-            public.payment pay
-        JOIN
-            public.customers c ON pay.custid = c.custid
-        WHERE
-            pay.phone IS NOT NULL AND pay.phone <> ''
-        GROUP BY
-            pay.phone, c.cname
-    ),
-    customer_purchase_counts AS (
-        SELECT
-            pay.phone,
-            COUNT(td.productno) AS total_purchases,
-            MIN(t.datein) AS first_purchase_date,
-            MAX(t.datein) AS last_purchase_date
-        FROM
-            public.transactiondetails td
-        JOIN
-            public.transactions t ON td.transactionid = t.id
-        JOIN
-            public.payment pay ON t.invoiceno = pay.invoiceno::text
-        WHERE
-            pay.phone IS NOT NULL AND pay.phone <> ''
-        GROUP BY
-            pay.phone
-    ),
-    most_purchased_items AS (
-        SELECT
-            pay.phone,
-            td.productno,
-            p.description AS product_description,
-            COUNT(td.productno) AS purchase_count
-        FROM
-            public.transactiondetails td
-        JOIN
-            public.transactions t ON td.transactionid = t.id
-        JOIN
-            public.payment pay ON t.invoiceno = pay.invoiceno::text
-        JOIN
-            public.product p ON td.productno = p.productno
-        WHERE
-            pay.phone IS NOT NULL AND pay.phone <> ''
-        GROUP BY
-            pay.phone, td.productno, p.description
-    ),
-    ranked_items AS (
-        SELECT
-            phone,
-            productno,
-            product_description,
-            purchase_count,
-            ROW_NUMBER() OVER (PARTITION BY phone ORDER BY purchase_count DESC) AS rn
-        FROM
-            most_purchased_items
-    ),
-    most_purchased_items_with_count AS (
-        SELECT
-            ri.phone,
-            ri.product_description AS most_purchased_item,
-            ri.purchase_count AS most_purchased_item_count
-        FROM
-            ranked_items ri
-        WHERE
-            ri.rn = 1
-    )
-    SELECT
-        cpt.phone,
-        cpt.customer_name,
-        cpc.total_purchases,
-        cpt.total_payments,
-        cpt.total_paid,
-        cpc.first_purchase_date,
-        cpc.last_purchase_date,
-        mpi.most_purchased_item,
-        mpi.most_purchased_item_count,
-        DATE_PART('day', cpc.last_purchase_date - cpc.first_purchase_date) AS purchase_duration_days
-    FROM
-        customer_payment_totals cpt
-    LEFT JOIN
-        customer_purchase_counts cpc ON cpt.phone = cpc.phone
-    LEFT JOIN
-        most_purchased_items_with_count mpi ON cpt.phone = mpi.phone
-    ORDER BY
-        cpt.total_paid DESC;
-    """
-    return fetch_data(query)
-
-
-# Function to fetch specific customer data by phone number
-@st.cache_data
-def get_customer_by_phone(phone):
-    query = f"""
-    WITH
-    customer_payments AS (
-        SELECT
-        phone,
-        COUNT(DISTINCT paymentid) AS total_payments,
-        SUM(amount) AS total_spent,
-        MIN(datein) AS first_payment_date,
-        MAX(datein) AS last_payment_date
-        FROM
-        public.payment
-        WHERE
-        phone = '{phone}'
-        GROUP BY
-        phone
-    )
-    SELECT
-        phone,
-        total_payments,
-        total_spent,
-        first_payment_date,
-        last_payment_date,
-        DATE_PART('day', last_payment_date - first_payment_date) AS payment_duration
-    FROM
-        customer_payments;
-    """
-    return fetch_data(query)
-
-# Function to fetch top 10 most purchased items
-@st.cache_data
-def get_top_10_items():
-    query = """
-    SELECT
-        p.description AS product_description,
-        COUNT(td.productno) AS purchase_count
-    FROM
-        public.transactiondetails td
-    JOIN
-        public.product p ON td.productno = p.productno
-    GROUP BY
-        p.description
-    ORDER BY
-        purchase_count DESC
-    LIMIT 10;
-    """
-    return fetch_data(query)
-
-# Function to fetch top 10 most purchased items for a specific customer by phone number
-@st.cache_data
-def get_top_10_items_by_phone(phone):
-    query = f"""
-    SELECT
-        p.description AS product_description,
-        COUNT(td.productno) AS purchase_count
-    FROM
-        public.transactiondetails td
-    JOIN
-        public.transactions t ON td.transactionid = t.id
-    JOIN
-        public.payment pay ON t.invoiceno = pay.invoiceno::text
-    JOIN
-        public.product p ON td.productno = p.productno
-    WHERE
-        pay.phone = '{phone}'
-    GROUP BY
-        p.description
-    ORDER BY
-        purchase_count DESC
-    LIMIT 10;
-    """
-    return fetch_data(query)
-
-# Function to fetch purchase history for a specific customer by phone number
-@st.cache_data
-def get_purchase_history_by_phone(phone):
-    query = f"""
-    SELECT
-        td.productno,
-        p.description AS product_description,
-        td.saleprice AS sold_price,
-        p.saleprice AS current_item_price,
-        td.quantity AS purchase_quantity,
-        (td.saleprice * td.quantity) AS total,
-        t.datein AS purchase_date
-    FROM
-        public.transactiondetails td
-        JOIN public.transactions t ON td.transactionid = t.id
-        JOIN public.payment pay ON t.invoiceno = pay.invoiceno::TEXT
-        JOIN public.product p ON td.productno = p.productno
-        JOIN public.customers c ON pay.custid = c.custid
-    WHERE
-        pay.phone = '{phone}';
-    """
-    return fetch_data(query)
-
-# Function to fetch payment history for a specific customer by phone number
-@st.cache_data
-def get_payment_history_by_phone(phone):
-    query = f"""
-    SELECT
-        invoiceno,
-        SUM(amount) AS total_paid,
-        MIN(datein) AS payment_date
-    FROM
-        public.payment
-    WHERE
-        phone = '{phone}'
-    GROUP BY
-        invoiceno
-    ORDER BY
-        invoiceno;
-    """
-    return fetch_data(query)
-
-@st.cache_data
+    # Purchase counts are per phone, payment totals per phone and customer name
+    purchase_counts = get_purchasing_customers().groupby('phone').agg(
+        total_purchases=('total_purchases', 'sum'),
+        first_purchase_date=('first_purchase_date', 'min'),
+        last_purchase_date=('last_purchase_date', 'max'),
+    ).reset_index()
+    df = load_customer_metrics()[[
+        'phone',
+        'customer_name',
+        'total_payments',
+        'total_paid',
+        'most_purchased_item',
+        'most_purchased_item_count',
+    ]].merge(purchase_counts, on='phone', how='left')
+    df['purchase_duration_days'] = (df['last_purchase_date'] - df['first_purchase_date']).dt.days
+    return df[[
+        'phone',
+        'customer_name',
+        'total_purchases',
+        'total_payments',
+        'total_paid',
+        'first_purchase_date',
+        'last_purchase_date',
+        'most_purchased_item',
+        'most_purchased_item_count',
+        'purchase_duration_days',
+    ]].sort_values('total_paid', ascending=False).reset_index(drop=True)
+
+# Phone number and name search options, shared across sessions and rebuilt along with the customer metrics
+@st.cache_resource(ttl=CUSTOMER_METRICS_TTL)
+def get_customer_labels():
+    return build_customer_labels(get_all_customer_data())
+
+# Every payment made from a phone number, joined to the purchase lines of its invoice.
+# Payments without purchase lines are kept, so one result covers both.
+CUSTOMER_PROFILE_QUERY = """
+SELECT
+    pay.paymentid,
+    pay.invoiceno,
+    pay.amount,
+    pay.datein AS payment_date,
+    c.custid IS NOT NULL AS known_customer,
+    p.productno IS NOT NULL AS product_line,
+    td.productno,
+    p.description AS product_description,
+    td.saleprice AS sold_price,
+    p.saleprice AS current_item_price,
+    td.quantity AS purchase_quantity,
+    t.datein AS purchase_date
+FROM
+    public.payment pay
+    LEFT JOIN public.customers c ON pay.custid = c.custid
+    LEFT JOIN public.transactions t ON t.invoiceno = pay.invoiceno::TEXT
+    LEFT JOIN public.transactiondetails td ON td.transactionid = t.id
+    LEFT JOIN public.product p ON td.productno = p.productno
+WHERE
+    pay.phone = :phone;
+"""
+
+# Everything the search tab shows for one customer, from a single round trip:
+#   customer: payment totals (empty if the phone has never paid)
+#   payment_history: amount paid and first payment date per invoice
+#   purchase_history: purchase lines of registered customers' payments
+#   top_items: 10 most purchased products
+#   top_product: purchase count and amount per product, most purchased first
+@result_cache(ttl=600, max_entries=500)
+def get_customer_profile(phone):
+    df = fetch_prepared("get_customer_profile", CUSTOMER_PROFILE_QUERY, {"phone": phone})
+
+    payments = df.drop_duplicates('paymentid')
+    if payments.empty:
+        customer = pd.DataFrame(columns=['phone', 'total_payments', 'total_spent', 'first_payment_date', 'last_payment_date', 'payment_duration'])
+    else:
+        first_payment_date, last_payment_date = payments['payment_date'].min(), payments['payment_date'].max()
+        customer = pd.DataFrame({
+            'phone': [phone],
+            'total_payments': [len(payments)],
+            'total_spent': [payments['amount'].sum()],
+            'first_payment_date': [first_payment_date],
+            'last_payment_date': [last_payment_date],
+            'payment_duration': [(last_payment_date - first_payment_date).days],
+        })
+
+    payment_history = payments.groupby('invoiceno').agg(
+        total_paid=('amount', 'sum'),
+        payment_date=('payment_date', 'min'),
+    ).reset_index()
+
+    lines = df.loc[df['product_line'].astype(bool)].copy()
+    lines['total'] = lines['sold_price'] * lines['purchase_quantity']
+    known_lines = lines.loc[lines['known_customer'].astype(bool)]
+    purchase_history = known_lines[[
+        'productno',
+        'product_description',
+        'sold_price',
+        'current_item_price',
+        'purchase_quantity',
+        'total',
+        'purchase_date',
+    ]].reset_index(drop=True)
+
+    top_items = lines.groupby('product_description').agg(
+        purchase_count=('productno', 'count'),
+    ).reset_index().sort_values('purchase_count', ascending=False, kind='stable').head(10).reset_index(drop=True)
+
+    top_product = known_lines.groupby(['productno', 'product_description']).agg(
+        total_amount=('total', 'sum'),
+        purchase_count=('productno', 'count'),
+    ).reset_index().sort_values('purchase_count', ascending=False, kind='stable').reset_index(drop=True)
+
+    return {
+        'customer': customer,
+        'payment_history': payment_history,
+        'purchase_history': purchase_history,
+        'top_items': top_items,
+        'top_product': top_product,
+    }
+
+@result_cache()
 def get_products():
-    products_query = """
-        SELECT
-        p.productno,
-        p.description,
-        p.saleprice,
-        p.buyprice,
-        COUNT(td.productno) AS purchase_count
-        FROM
-        product p
-        LEFT JOIN transactiondetails td ON p.productno = td.productno
-        GROUP BY
-        p.productno,
-        p.description,
-        p.saleprice,
-        p.buyprice
-        ORDER BY
-        p.productno;
-    """
-    return fetch_data(products_query)
-
-@st.cache_data
-def get_top_product(phone):
-    query = f"""
-    SELECT
-        td.productno,
-        p.description AS product_description,
-        SUM(td.saleprice * td.quantity) AS total_amount,
-        COUNT(td.productno) AS purchase_count
-    FROM
-        public.transactiondetails td
-        JOIN public.transactions t ON td.transactionid = t.id
-        JOIN public.payment pay ON t.invoiceno = pay.invoiceno::TEXT
-        JOIN public.product p ON td.productno = p.productno
-        JOIN public.customers c ON pay.custid = c.custid
-    WHERE
-        pay.phone = '{phone}'
-    GROUP BY    
-        td.productno,
-        p.description
-    ORDER BY
-         purchase_count DESC;
-    """
-    results = fetch_data(query)
-    
-    return results
-
+    return fetch_products()
 
 # Main function to render the Streamlit page
 def main():
@@ -280,11 +144,12 @@ def main():
     st.title("Customer Relationship Dashboard")
     st.sidebar.markdown('# Home') 
     st.sidebar.markdown('Manage your top customers, ranked by their total purchase contribution in "📈 Overview: All Customers".')
-    st.sidebar.markdown('Copy a phone number and search up their data in the 2nd tab named "🔍 Search for a Customer" and recommend your products.')
+    st.sidebar.markdown('Search a customer by phone number or name in the 2nd tab named "🔍 Search for a Customer" and recommend your products.')
     st.logo(
         st.secrets["LOGO"],
         icon_image=st.secrets["ICON"],
     )  
+    start_prewarm()
 
     tab1, tab2 = st.tabs(["📈 Overview: All Customers", "🔍 Search for a Customer"])
 
@@ -307,11 +172,20 @@ def main():
     # Search for specific customer information
     with tab2:
         st.subheader("Search for Customer Information")
-        phone_number = st.text_input("Enter Customer Phone Number:", "")
+        # Filters as the user types; only phone numbers of known customers are ever queried
+        customer_labels = get_customer_labels()
+        phone_number = st.selectbox(
+            "Customer Phone Number or Name:",
+            list(customer_labels),
+            index=None,
+            format_func=customer_labels.get,
+            placeholder="Start typing a phone number or name",
+        )
 
         if phone_number:
             # Fetch and display specific customer data
-            customer_data = get_customer_by_phone(phone_number)
+            profile = get_customer_profile(phone_number)
+            customer_data = profile['customer']
             
             if not customer_data.empty:
                 st.subheader(f"Customer Data for Phone Number: {phone_number}")
@@ -328,17 +202,17 @@ def main():
                 col3.metric("Days With Us", f"{payment_duration_days}")
 
                 # Display customer payment history
-                payment_history = get_payment_history_by_phone(phone_number)
+                payment_history = profile['payment_history']
                 st.subheader("Payment History")
                 st.dataframe(payment_history)
 
                 # Display customer purchase history
-                purchase_history = get_purchase_history_by_phone(phone_number)
+                purchase_history = profile['purchase_history']
                 st.subheader("Purchase History")
                 st.dataframe(purchase_history)
 
                 # Display top 10 most purchased items for this customer
-                top_customer_items = get_top_10_items_by_phone(phone_number)
+                top_customer_items = profile['top_items']
                 st.subheader("Top 10 Most Purchased Items")
                 st.bar_chart(top_customer_items.set_index('product_description')['purchase_count'])
 
@@ -346,9 +220,15 @@ def main():
                     st.subheader("Other Product Recommendations")
                 
                     if st.button('Get Recommendations'):
-                        top_prod = get_top_product(phone_number)
-                        recommendations = get_recommendations(top_prod.iloc[0]['productno'], get_products())
-                        st.write(f"Because they liked {top_prod.iloc[0]['product_description']}")
+                        # Precomputed for every customer, computed live for customers not in the table yet
+                        recommendations = get_customer_recommendations(phone_number)
+                        if not recommendations.empty:
+                            top_product_description = recommendations.iloc[0]['most_purchased_item']
+                        else:
+                            top_prod = profile['top_product']
+                            recommendations = get_recommendations(top_prod.iloc[0]['productno'], get_products())
+                            top_product_description = top_prod.iloc[0]['product_description']
+                        st.write(f"Because they liked {top_product_description}")
                         st.metric(label="Top Recommendation", value=f"{recommendations.iloc[0]['description']}", delta=f"{recommendations.iloc[0]['saleprice']}")
                         st.write("Other recommendations")
                         st.write(recommendations[['productno', 'description', 'saleprice']])
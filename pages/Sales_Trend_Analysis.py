@@ -1,8 +1,10 @@
 import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
-from utils.database import fetch_data
-from utils.preprocessing import preprocess_data
+from utils.cache import result_cache
+from utils.database import fetch_data, fetch_prepared, fetch_data_chunks, sum_chunks, fetch_sales_rollup
+from utils.sales_cube import peek_sales_cube, query_sales_cube
+from utils.prewarm import start_prewarm
 from datetime import datetime, date
 
 st.set_page_config(
@@ -10,20 +12,27 @@ st.set_page_config(
     page_icon=st.secrets["FAVICON"],
     layout="wide",
 )
+start_prewarm()
 
+# Rows of the purchases table; totals still cover the whole date range
+PURCHASES_TABLE_ROWS = int(st.secrets.get('PURCHASES_TABLE_ROWS', 10000))
 
 
-@st.cache_data
+@result_cache()
 def load_data():
-    payment_query = "SELECT datein, amount, custid as customer_id FROM payment;"
-    df = fetch_data(payment_query)
-    df = preprocess_data(df)
     customers_query = "SELECT custid as customer_id, cname FROM customers;"
     customers_df = fetch_data(customers_query)
-    return df, customers_df
+    return customers_df
 
-# Load and preprocess data
-df, customers_df = load_data()
+# Totals per period aggregated in the database, used until the sales cube is built
+@result_cache(ttl=600, max_entries=500)
+def get_sales_rollup(freq, start_date, end_date, excluded_customer_ids=()):
+    return fetch_sales_rollup(freq, start_date, end_date, excluded_customer_ids)
+
+# Load data, daily sales per customer are held in the shared sales cube once the
+# prewarm thread has built it
+sales_cube = peek_sales_cube()
+customers_df = load_data()
 # Initialize session state for date inputs
 if 'start_date' not in st.session_state:
     st.session_state.start_date = datetime.strptime("2000-01-01", "%Y-%m-%d").date()
@@ -31,17 +40,16 @@ if 'end_date' not in st.session_state:
     st.session_state.end_date = datetime.now().date()
 
 # Ensure session state dates are valid
+has_sales_days = sales_cube is not None and len(sales_cube['days']) > 0
 if pd.isna(st.session_state.start_date) or not isinstance(st.session_state.start_date, date):
-    st.session_state.start_date = df.index.min().date()
+    st.session_state.start_date = sales_cube['days'][0].date() if has_sales_days else date(2019, 1, 1)
 if pd.isna(st.session_state.end_date) or not isinstance(st.session_state.end_date, date):
-    st.session_state.end_date = df.index.max().date()
+    st.session_state.end_date = sales_cube['days'][-1].date() if has_sales_days else datetime.now().date()
 
 
 # Function to plot sales trend with interactivity
-def plot_sales_trend(df):
-    df = df[(df.index >= pd.to_datetime(st.session_state.start_date)) & (df.index <= pd.to_datetime(st.session_state.end_date))]
+def plot_sales_trend(df_monthly):
     st.subheader("Monthly Sales Trend")
-    df_monthly = df[['amount']].resample('MS').sum()
 
     fig, ax = plt.subplots(figsize=(12, 6))
     ax.plot(df_monthly.index, df_monthly['amount'], marker='o')
@@ -52,11 +60,8 @@ def plot_sales_trend(df):
     st.pyplot(fig)
 
 # Function to plot weekly sales trend with interactivity
-def plot_weekly_sales(df):
-    df = df[(df.index >= pd.to_datetime(st.session_state.start_date)) & (df.index <= pd.to_datetime(st.session_state.end_date))]
-
+def plot_weekly_sales(df_weekly):
     st.subheader("Weekly Sales Trend")
-    df_weekly = df[['amount']].resample('W-MON').sum()
 
     fig, ax = plt.subplots(figsize=(12, 6))
     ax.plot(df_weekly.index, df_weekly['amount'], marker='o', color='orange')
@@ -67,11 +72,8 @@ def plot_weekly_sales(df):
     st.pyplot(fig)
 
 # Function to plot daily sales trend with interactivity
-def plot_daily_sales(df):
-    df = df[(df.index >= pd.to_datetime(st.session_state.start_date)) & (df.index <= pd.to_datetime(st.session_state.end_date))]
-
+def plot_daily_sales(df_daily):
     st.subheader("Daily Sales Trend")
-    df_daily = df[['amount']].resample('D').sum()
 
     fig, ax = plt.subplots(figsize=(12, 6))
     ax.plot(df_daily.index, df_daily['amount'], marker='o', color='red')
@@ -82,11 +84,9 @@ def plot_daily_sales(df):
     st.pyplot(fig)
 
 # Function to plot monthly sales with rolling average with interactivity
-def plot_monthly_sales_with_rolling_avg(df):
-    df = df[(df.index >= pd.to_datetime(st.session_state.start_date)) & (df.index <= pd.to_datetime(st.session_state.end_date))]
-
+def plot_monthly_sales_with_rolling_avg(df_monthly):
     st.subheader("Monthly Sales with Rolling Average")
-    df_monthly = df[['amount']].resample('MS').sum()
+    df_monthly = df_monthly.copy()
     df_monthly['rolling_avg'] = df_monthly['amount'].rolling(window=3).mean()
 
     fig, ax = plt.subplots(figsize=(12, 6))
@@ -99,9 +99,12 @@ def plot_monthly_sales_with_rolling_avg(df):
     ax.grid(True)
     st.pyplot(fig)
 
-@st.cache_data
+# Purchases in the date range, newest first, and their totals. The range can cover
+# the whole payment table, so it is streamed and only the newest
+# PURCHASES_TABLE_ROWS rows are kept for the table.
+@result_cache(ttl=600, max_entries=500)
 def get_purchases_within_range(start_date=st.session_state.start_date, end_date=st.session_state.end_date):
-    query = f'''
+    query = '''
     SELECT
         p.paymentid,
         p.amount,
@@ -115,15 +118,29 @@ def get_purchases_within_range(start_date=st.session_state.start_date, end_date=
         payment p
     JOIN customers c ON p.custid = c.custid
     WHERE
-        p.datein BETWEEN \'{st.session_state.start_date}\' AND \'{st.session_state.end_date}\';
+        p.datein BETWEEN :start_date AND :end_date
+    ORDER BY
+        p.datein DESC;
     
     '''
-
-    return fetch_data(query)
-
-@st.cache_data
+    newest = []
+
+    def keep_newest(chunks):
+        kept = 0
+        for chunk in chunks:
+            if kept < PURCHASES_TABLE_ROWS:
+                newest.append(chunk.head(PURCHASES_TABLE_ROWS - kept))
+                kept += len(newest[-1])
+            yield chunk.assign(purchases=1)
+
+    chunks = fetch_data_chunks(query, {"start_date": start_date, "end_date": end_date})
+    totals = sum_chunks(keep_newest(chunks), ['amount', 'purchases'])
+    purchases = pd.concat(newest, ignore_index=True) if newest else pd.DataFrame()
+    return purchases, totals
+
+@result_cache(ttl=600, max_entries=500)
 def get_invoice_info(invoice_number):
-    query = f'''
+    query = '''
     SELECT
         (td.saleprice * td.quantity) AS total,
         ti.custid,
@@ -139,11 +156,11 @@ def get_invoice_info(invoice_number):
         JOIN transactiondetails td ON ti.id = td.transactionid
         JOIN product p ON td.productno = p.productno
     WHERE
-     ti.invoiceno = \'{invoice_number}\';
+     ti.invoiceno = :invoice_number;
     
     '''
 
-    return fetch_data(query)
+    return fetch_prepared("get_invoice_info", query, {"invoice_number": invoice_number})
 
 def format_date(date):
     return date.strftime("%B %d, %Y")
@@ -174,12 +191,16 @@ customer_filter = st.sidebar.multiselect(
     options=customers_df['cname'].tolist()
 )
 
+customer_ids_to_exclude = ()
 if customer_filter:
-    customer_ids_to_exclude = customers_df[customers_df['cname'].isin(customer_filter)]['customer_id'].values
-    df = df[~df['customer_id'].isin(customer_ids_to_exclude)]
+    customer_ids_to_exclude = tuple(customers_df[customers_df['cname'].isin(customer_filter)]['customer_id'].tolist())
 
-# Filter the data based on the selected date range
-df = df[(df.index >= pd.to_datetime(st.session_state.start_date)) & (df.index <= pd.to_datetime(st.session_state.end_date))]
+# Sales totals for the selected date range, sliced from the sales cube, or
+# aggregated in the database while the cube is not built yet
+def sales_rollup(freq):
+    if sales_cube is None:
+        return get_sales_rollup(freq, st.session_state.start_date, st.session_state.end_date, customer_ids_to_exclude)
+    return query_sales_cube(sales_cube, freq, st.session_state.start_date, st.session_state.end_date, customer_ids_to_exclude)
 
 # Adding interactive options to the sidebar
 st.sidebar.markdown("## Plot Selection")
@@ -196,16 +217,22 @@ tab1, tab2 = st.tabs(["Charts", "Table"])
 
 with tab1:
     if 'Monthly' in options:
-        plot_sales_trend(df)
+        plot_sales_trend(sales_rollup('MS'))
     if 'Weekly' in options:
-        plot_weekly_sales(df)
+        plot_weekly_sales(sales_rollup('W-MON'))
     if 'Daily' in options:
-        plot_daily_sales(df)
+        plot_daily_sales(sales_rollup('D'))
     if 'Monthly with Rolling Average' in options:
-        plot_monthly_sales_with_rolling_avg(df)
+        plot_monthly_sales_with_rolling_avg(sales_rollup('MS'))
 with tab2:
     st.subheader(f"Purchases from :green[{format_date(st.session_state.start_date)}] to :green[{format_date(st.session_state.end_date)}]")
-    st.dataframe(get_purchases_within_range(), use_container_width=True)
+    purchases, purchase_totals = get_purchases_within_range(st.session_state.start_date, st.session_state.end_date)
+    col1, col2 = st.columns(2)
+    col1.metric("Purchases", f"{int(purchase_totals['purchases']):,}")
+    col2.metric("Total Amount", f"{purchase_totals['amount']:,.2f}")
+    if purchase_totals['purchases'] > len(purchases):
+        st.caption(f"Showing the latest {len(purchases):,} purchases")
+    st.dataframe(purchases, use_container_width=True)
 
     with st.container(border=True):
         st.subheader("Search for Invoice information")
@@ -4,7 +4,7 @@ import time
 from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainingArguments, DataCollatorForLanguageModeling
 from datasets import Dataset
 from dotenv import load_dotenv
-from utils.database import fetch_sales_data
+from utils.customer_metrics import fetch_sales_data
 import logging
 
 # Start timer
@@ -0,0 +1,95 @@
+import time
+import numpy as np
+
+# Approximate nearest neighbours for cosine similarity with random-projection LSH.
+# Every table hashes a vector to the signs of n_bits random projections, so similar
+# vectors tend to share a bucket. A query only scores the products in its buckets
+# (plus `probes` neighbouring buckets per table, found by flipping the bits whose
+# projections were closest to zero) exactly, instead of the whole catalog.
+# More tables or probes raise recall, more bits make buckets smaller and queries faster.
+class LSHIndex:
+    def __init__(self, tfidf_matrix, n_tables=16, n_bits=10, probes=2, seed=0, batch_size=4096):
+        self.tfidf_matrix = tfidf_matrix
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.probes = probes
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((tfidf_matrix.shape[1], n_tables * n_bits)).astype('float32')
+        self.bit_values = np.left_shift(1, np.arange(n_bits, dtype='int64'))
+
+        codes = np.empty((tfidf_matrix.shape[0], n_tables), dtype='int64')
+        for start in range(0, tfidf_matrix.shape[0], batch_size):
+            projections = np.asarray(tfidf_matrix[start:start + batch_size] @ self.planes)
+            codes[start:start + batch_size] = self.hash(projections)
+        # Buckets are runs of equal codes in each table's sorted order
+        self.order = np.argsort(codes, axis=0, kind='stable')
+        self.sorted_codes = np.take_along_axis(codes, self.order, axis=0)
+
+    def hash(self, projections):
+        signs = (projections > 0).reshape(len(projections), self.n_tables, self.n_bits)
+        return signs @ self.bit_values
+
+    # Bucket codes to look up for one query: its own bucket plus the closest neighbours
+    def probe_codes(self, projection):
+        codes = self.hash(projection[np.newaxis])[0]
+        probe_codes = [codes[np.newaxis]]
+        if self.probes:
+            margins = np.abs(projection).reshape(self.n_tables, self.n_bits)
+            flips = np.argsort(margins, axis=1)[:, :self.probes]
+            probe_codes.append((codes[:, np.newaxis] ^ self.bit_values[flips]).T)
+        return np.vstack(probe_codes)
+
+    def candidates(self, row):
+        projection = np.asarray(self.tfidf_matrix[row] @ self.planes)[0]
+        probe_codes = self.probe_codes(projection)
+        found = []
+        for table in range(self.n_tables):
+            sorted_codes = self.sorted_codes[:, table]
+            for code in probe_codes[:, table]:
+                start, end = np.searchsorted(sorted_codes, [code, code + 1])
+                found.append(self.order[start:end, table])
+        return np.unique(np.concatenate(found))
+
+    # For each row, up to k other rows with the highest exact cosine among its candidates, best first
+    def nearest(self, rows, k=10):
+        results = []
+        for row in np.atleast_1d(rows):
+            candidates = self.candidates(row)
+            candidates = candidates[candidates != row]
+            scores = (self.tfidf_matrix[row] @ self.tfidf_matrix[candidates].T).toarray()[0]
+            if len(candidates) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                candidates, scores = candidates[top], scores[top]
+            results.append(candidates[np.argsort(-scores, kind='stable')])
+        return results
+
+# Recall@k of the index against exact cosine on a sample of products, with mean query times
+def recall_report(index, k=10, sample=200, seed=0):
+    tfidf_matrix = index.tfidf_matrix
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(tfidf_matrix.shape[0], size=min(sample, tfidf_matrix.shape[0]), replace=False)
+
+    start = time.perf_counter()
+    approximate = index.nearest(rows, k=k)
+    ann_ms = (time.perf_counter() - start) / len(rows) * 1000
+
+    hits, total = 0, 0
+    start = time.perf_counter()
+    for row, found in zip(rows, approximate):
+        scores = (tfidf_matrix @ tfidf_matrix[row].T).toarray()[:, 0]
+        scores[row] = -np.inf
+        exact = np.argpartition(-scores, k - 1)[:k]
+        # Count neighbours tied with the k-th exact score as hits as well
+        threshold = scores[exact].min()
+        hits += min(k, int(np.sum(scores[found] >= threshold)))
+        total += k
+    exact_ms = (time.perf_counter() - start) / len(rows) * 1000
+
+    return {
+        'recall': hits / total,
+        'ann_ms_per_query': ann_ms,
+        'exact_ms_per_query': exact_ms,
+        'n_tables': index.n_tables,
+        'n_bits': index.n_bits,
+        'probes': index.probes,
+    }
@@ -0,0 +1,177 @@
+import contextlib
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import streamlit as st
+
+# 'memory' keeps results inside this process, 'sqlite' shares them between worker processes
+CACHE_BACKEND = st.secrets.get('CACHE_BACKEND', 'memory')
+CACHE_PATH = st.secrets.get('CACHE_PATH', 'data/cache.sqlite')
+CACHE_TTL = int(st.secrets.get('CACHE_TTL', 3600))  # Seconds
+CACHE_MAX_ENTRIES = int(st.secrets.get('CACHE_MAX_ENTRIES', 256))  # Per cached function
+CACHE_MAX_BYTES = int(st.secrets.get('CACHE_MAX_BYTES', 256 * 1024 * 1024))  # Per cached function
+
+# Backends and counters live at module level so they survive Streamlit re-running the page scripts
+BACKENDS = {}
+CACHE_STATS = {}
+
+# Pickled results in least recently used order, evicted once there are more
+# than max_entries of them or they take more than max_bytes
+class MemoryBackend:
+    def __init__(self, name, max_entries, max_bytes):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.size -= len(self.entries.pop(key)[1])
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # Store a value, returning how many entries were evicted to make room
+    def set(self, key, value, expires):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[1])
+            self.entries[key] = (expires, value)
+            self.size += len(value)
+            evicted = 0
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+                evicted += 1
+            return evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+# Same behaviour in one SQLite file, so every process on the host shares the results
+class SQLiteBackend:
+    def __init__(self, name, max_entries, max_bytes, path=CACHE_PATH):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "name TEXT, key TEXT, value BLOB, size INTEGER, expires REAL, accessed REAL, "
+                "PRIMARY KEY (name, key))"
+            )
+
+    # Commits on success and always closes the connection
+    @contextlib.contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT value, expires FROM results WHERE name = ? AND key = ?", (self.name, key)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                connection.execute("DELETE FROM results WHERE name = ? AND key = ?", (self.name, key))
+                return None
+            connection.execute(
+                "UPDATE results SET accessed = ? WHERE name = ? AND key = ?", (time.time(), self.name, key)
+            )
+            return row[0]
+
+    def set(self, key, value, expires):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (self.name, key, value, len(value), expires, time.time()),
+            )
+            connection.execute("DELETE FROM results WHERE name = ? AND expires < ?", (self.name, time.time()))
+            # Least recently used first; keep the newest entry even if it alone is over max_bytes
+            rows = connection.execute(
+                "SELECT key, size FROM results WHERE name = ? ORDER BY accessed DESC", (self.name,)
+            ).fetchall()
+            evict, total = [], 0
+            for position, (row_key, size) in enumerate(rows):
+                total += size
+                if position > 0 and (position >= self.max_entries or total > self.max_bytes):
+                    evict.append((self.name, row_key))
+            connection.executemany("DELETE FROM results WHERE name = ? AND key = ?", evict)
+            return len(evict)
+
+    def clear(self):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM results WHERE name = ?", (self.name,))
+
+def get_backend(backend, name, max_entries, max_bytes):
+    if name not in BACKENDS:
+        if backend == 'sqlite':
+            BACKENDS[name] = SQLiteBackend(name, max_entries, max_bytes)
+        elif backend == 'memory':
+            BACKENDS[name] = MemoryBackend(name, max_entries, max_bytes)
+        else:
+            raise ValueError(f"Unknown cache backend: {backend}")
+    return BACKENDS[name]
+
+# Cache a function's results by its arguments, for at most ttl seconds and
+# max_entries / max_bytes per function, least recently used results evicted first.
+# Like st.cache_data, callers get their own unpickled copy of a cached result.
+def result_cache(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, backend=None):
+    def decorator(func):
+        # The code hash (bytecode and literals such as the SQL text) keeps results
+        # of an edited function apart from the old ones
+        literals = [c for c in func.__code__.co_consts if isinstance(c, (str, bytes, int, float))]
+        code_hash = hashlib.sha1(func.__code__.co_code + repr(literals).encode('utf-8')).hexdigest()[:12]
+        name = f"{func.__module__}.{func.__qualname__}:{code_hash}"
+        store = get_backend(backend or CACHE_BACKEND, name, max_entries, max_bytes)
+        stats = CACHE_STATS.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+
+        def make_key(args, kwargs):
+            return hashlib.sha1(pickle.dumps((args, sorted(kwargs.items())))).hexdigest()
+
+        # Recompute and store a result without looking at the cache, so readers
+        # keep getting the previous result until the new one replaces it
+        def refresh(*args, **kwargs):
+            result = func(*args, **kwargs)
+            stats['evictions'] += store.set(make_key(args, kwargs), pickle.dumps(result), time.time() + ttl)
+            return result
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            value = store.get(make_key(args, kwargs))
+            if value is not None:
+                stats['hits'] += 1
+                return pickle.loads(value)
+            stats['misses'] += 1
+            return refresh(*args, **kwargs)
+
+        wrapper.clear = store.clear
+        wrapper.refresh = refresh
+        wrapper.stats = stats
+        return wrapper
+    return decorator
+
+# Hit, miss and eviction counters of every cached function in this process
+def cache_stats():
+    return {name: dict(stats) for name, stats in CACHE_STATS.items()}
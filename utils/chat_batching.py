@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import streamlit as st
+import torch
+from transformers import DynamicCache
+from transformers.generation.streamers import BaseStreamer
+from utils.chat_model import CHAT_CONTEXT, CHAT_MAX_NEW_TOKENS, CHAT_STREAM_TIMEOUT, load_chat_model, timed_stream
+
+# Prompts from all sessions arriving within CHAT_BATCH_WINDOW_MS of the first
+# one are generated together, up to CHAT_MAX_BATCH at a time
+CHAT_BATCHING = bool(st.secrets.get('CHAT_BATCHING', True))
+CHAT_BATCH_WINDOW_MS = int(st.secrets.get('CHAT_BATCH_WINDOW_MS', 50))
+CHAT_MAX_BATCH = int(st.secrets.get('CHAT_MAX_BATCH', 8))
+
+# Routes the tokens of a batched generate to one text queue per prompt, each
+# ending with None once its row reaches an end of sequence token or generation stops
+class BatchStreamer(BaseStreamer):
+    def __init__(self, tokenizer, eos_token_ids, outputs):
+        self.tokenizer = tokenizer
+        self.eos_token_ids = set(eos_token_ids)
+        self.outputs = outputs
+        self.tokens = [[] for _ in outputs]
+        self.texts = ['' for _ in outputs]
+        self.finished = [False for _ in outputs]
+        self.prompt_seen = False
+
+    def put(self, value):
+        # generate passes the prompt ids first, then one new token per row at a time
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, token in enumerate(value.reshape(len(self.outputs), -1)[:, -1].tolist()):
+            if self.finished[row]:
+                continue
+            if token in self.eos_token_ids:
+                self.finish(row)
+                continue
+            self.tokens[row].append(token)
+            text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+            # Hold back partial multi-byte characters until the next token completes them
+            if not text.endswith('�') and len(text) > len(self.texts[row]):
+                self.outputs[row].put(text[len(self.texts[row]):])
+                self.texts[row] = text
+
+    def finish(self, row):
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        if len(text) > len(self.texts[row]):
+            self.outputs[row].put(text[len(self.texts[row]):])
+        self.outputs[row].put(None)
+        self.finished[row] = True
+
+    def end(self):
+        for row, finished in enumerate(self.finished):
+            if not finished:
+                self.finish(row)
+
+# Micro-batching inference queue shared by every session. A single worker thread
+# takes the first waiting prompt, gathers whatever else arrives within the window,
+# and runs one padded generate for all of them, so concurrent users share forward
+# passes instead of queueing behind each other's single-prompt generations.
+class ChatBatcher:
+    def __init__(self, chat_model, window_ms=CHAT_BATCH_WINDOW_MS, max_batch=CHAT_MAX_BATCH, max_new_tokens=CHAT_MAX_NEW_TOKENS):
+        self.chat_model = chat_model
+        self.max_new_tokens = max_new_tokens
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        tokenizer = chat_model['tokenizer']
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = 'left'  # Decoder-only models continue from the last position of every row
+        eos_token_id = chat_model['model'].generation_config.eos_token_id
+        self.eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        self.batch_sizes = deque(maxlen=100)  # Sizes of the latest batches, for monitoring
+        self.worker = threading.Thread(target=self.run, name='chat-batcher', daemon=True)
+        self.worker.start()
+
+    # Yield the response text to one prompt as it is generated, for st.write_stream
+    def stream(self, prompt_input):
+        start = time.perf_counter()
+        texts = queue.Queue()
+        self.requests.put((prompt_input, texts))
+
+        def receive():
+            while (text := texts.get(timeout=CHAT_STREAM_TIMEOUT)) is not None:
+                if isinstance(text, Exception):
+                    raise text
+                yield text
+
+        yield from timed_stream(receive(), start)
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.generate([prompt for prompt, _ in batch], [texts for _, texts in batch])
+            except Exception as e:
+                print(f"{datetime.now()}: Batched generation of {len(batch)} prompts failed: {e}")
+                for _, texts in batch:
+                    texts.put(e)
+
+    # Without the prefix cache every prompt is tokenized in full and left padded.
+    # With it the shared context comes first in every row, followed by the padding
+    # and then the user's part, so the context's cached keys and values line up
+    # with every row; masked padding is skipped and position ids skip over it.
+    def prepare_batch(self, prompts):
+        model, tokenizer = self.chat_model['model'], self.chat_model['tokenizer']
+        if self.chat_model['prefix_cache'] is None:
+            return tokenizer([f"{CHAT_CONTEXT} {prompt} \nAssistant:" for prompt in prompts], return_tensors="pt", padding=True).to(model.device)
+        suffixes = tokenizer([f" {prompt} \nAssistant:" for prompt in prompts], add_special_tokens=False, return_tensors="pt", padding=True).to(model.device)
+        prefix_ids = self.chat_model['prefix_ids'].expand(len(prompts), -1)
+        prefix_cache = self.chat_model['prefix_cache']
+        batch_cache = DynamicCache()
+        for layer in range(len(prefix_cache)):
+            key, value = prefix_cache[layer]
+            batch_cache.update(key.repeat(len(prompts), 1, 1, 1), value.repeat(len(prompts), 1, 1, 1), layer)
+        return {
+            'input_ids': torch.cat([prefix_ids, suffixes['input_ids']], dim=1),
+            'attention_mask': torch.cat([torch.ones_like(prefix_ids), suffixes['attention_mask']], dim=1),
+            'past_key_values': batch_cache,
+        }
+
+    def generate(self, prompts, outputs):
+        model, tokenizer = self.chat_model['model'], self.chat_model['tokenizer']
+        inputs = self.prepare_batch(prompts)
+        streamer = BatchStreamer(tokenizer, self.eos_token_ids, outputs)
+        with torch.inference_mode():
+            model.generate(**inputs, streamer=streamer, max_new_tokens=self.max_new_tokens, use_cache=True,
+                           pad_token_id=tokenizer.pad_token_id)
+        self.batch_sizes.append(len(prompts))
+
+# One queue and worker per process, around the shared chat model
+@st.cache_resource
+def get_chat_batcher():
+    return ChatBatcher(load_chat_model())
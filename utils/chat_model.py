@@ -0,0 +1,189 @@
+import copy
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import psutil
+import streamlit as st
+import torch
+from peft import AutoPeftModelForCausalLM
+from transformers import AutoTokenizer, DynamicCache, TextIteratorStreamer
+
+# Hugging Face model and tokenizer
+MODEL_PATH = st.secrets["MODEL_PATH"]
+CHAT_LOAD_IN_4BIT = bool(st.secrets.get('CHAT_LOAD_IN_4BIT', True))  # Adjust based on your setup, GPU only
+# 'auto' uses the GPU when there is one, 'cpu' or 'cuda' force a device
+CHAT_DEVICE = st.secrets.get('CHAT_DEVICE', 'auto')
+# CPU only: int8 dynamic quantization of the linear layers, and threads for torch
+CHAT_QUANTIZE = bool(st.secrets.get('CHAT_QUANTIZE', True))
+CHAT_THREADS = int(st.secrets.get('CHAT_THREADS', psutil.cpu_count(logical=False) or 1))
+CHAT_MAX_NEW_TOKENS = int(st.secrets.get('CHAT_MAX_NEW_TOKENS', 64))
+# Encode the fixed context once and reuse its attention keys and values for every prompt
+CHAT_PREFIX_CACHE = bool(st.secrets.get('CHAT_PREFIX_CACHE', True))
+CHAT_STREAM_TIMEOUT = int(st.secrets.get('CHAT_STREAM_TIMEOUT', 120))  # Seconds to wait for the next token
+
+# Time to first token and total time of the latest streamed responses, kept at module level across sessions
+RESPONSE_TIMINGS = deque(maxlen=100)
+
+# Detailed context put in front of every prompt
+CHAT_CONTEXT = (
+    "You are a data analysis assistant specializing in sales data for a supermarket in a hotel. "
+    "Your responses should be relevant to sales data analysis, customer trends, "
+    "and provide insightful information. Avoid providing unrelated information. "
+    "Answer in a concise and professional manner.\n\n"
+    "Example:\n"
+    "User: Can you provide an analysis of our monthly sales trends?\n"
+    "Assistant: Certainly! Based on the sales data from the past six months, we see a steady increase in sales volume, with a peak in December. The most popular product during this period was the Galaxy S4, accounting for 30% of total sales.\n\n"
+    "User: "
+)
+
+def rss_bytes():
+    return psutil.Process(os.getpid()).memory_info().rss
+
+# Token ids of the context and the model's key/value cache after reading them
+def encode_prefix(model, tokenizer):
+    prefix_ids = tokenizer(CHAT_CONTEXT, return_tensors="pt")['input_ids'].to(model.device)
+    with torch.no_grad():
+        prefix_cache = model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+    return prefix_ids, prefix_cache
+
+def resolve_device(device=CHAT_DEVICE):
+    if device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
+# On the GPU the adapter stays separate and the base model is loaded in 4 bits.
+# bitsandbytes needs CUDA, so on the CPU the LoRA weights are merged into a
+# float32 base model instead (no adapter overhead per forward pass) and its
+# linear layers are quantized to int8 with dynamic activation scales.
+def build_chat_model(device=CHAT_DEVICE, quantize=CHAT_QUANTIZE, threads=CHAT_THREADS):
+    device = resolve_device(device)
+    print(f"{datetime.now()}: Loading chat model from {MODEL_PATH} for {device}")
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    if device == 'cuda':
+        model = AutoPeftModelForCausalLM.from_pretrained(MODEL_PATH, load_in_4bit=CHAT_LOAD_IN_4BIT)
+        # 4-bit models are placed on the GPU by bitsandbytes when they are loaded
+        if not CHAT_LOAD_IN_4BIT:
+            model = model.to("cuda")
+    else:
+        torch.set_num_threads(threads)
+        model = AutoPeftModelForCausalLM.from_pretrained(MODEL_PATH, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+        model = model.merge_and_unload()
+        if quantize:
+            torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+    prefix_ids, prefix_cache = encode_prefix(model, tokenizer) if CHAT_PREFIX_CACHE else (None, None)
+    chat_model = {
+        'model': model,
+        'tokenizer': tokenizer,
+        'device': device,
+        'quantized': device == 'cpu' and quantize,
+        'threads': torch.get_num_threads(),
+        'prefix_ids': prefix_ids,
+        'prefix_cache': prefix_cache,
+        'load_seconds': time.perf_counter() - start,
+        'model_bytes': model.get_memory_footprint(),
+        'rss_delta_bytes': rss_bytes() - rss_before,
+    }
+    print(f"{datetime.now()}: Chat model loaded in {chat_model['load_seconds']:.1f}s on {model.device}")
+    return chat_model
+
+# Loaded once per process and shared by every session, instead of on every rerun of the page.
+#   model, tokenizer: ready for generate; inputs go to model.device
+#   device, quantized, threads: how the model runs
+#   prefix_ids, prefix_cache: the encoded context (None with CHAT_PREFIX_CACHE off)
+#   load_seconds: time taken to load both
+#   model_bytes: size of the model's parameters and buffers (int8 packed weights are not counted)
+#   rss_delta_bytes: growth of the process' resident memory while loading
+@st.cache_resource
+def load_chat_model():
+    return build_chat_model()
+
+# Load and current memory figures, for display next to the chat
+def chat_model_metrics(chat_model):
+    metrics = {
+        'device': chat_model['device'],
+        'quantized': chat_model['quantized'],
+        'threads': chat_model['threads'],
+        'prefix_tokens': 0 if chat_model['prefix_ids'] is None else chat_model['prefix_ids'].shape[1],
+        'load_seconds': chat_model['load_seconds'],
+        'model_mb': chat_model['model_bytes'] / 1e6,
+        'load_rss_mb': chat_model['rss_delta_bytes'] / 1e6,
+        'process_rss_mb': rss_bytes() / 1e6,
+    }
+    if torch.cuda.is_available():
+        metrics['cuda_allocated_mb'] = torch.cuda.memory_allocated() / 1e6
+    if RESPONSE_TIMINGS:
+        metrics['ttft_last_seconds'] = RESPONSE_TIMINGS[-1]['ttft_seconds']
+        metrics['ttft_median_seconds'] = statistics.median(timing['ttft_seconds'] for timing in RESPONSE_TIMINGS)
+    return metrics
+
+# generate keyword arguments for one prompt. With the prefix cache only the
+# user's part is tokenized, and generate only runs the model over the tokens
+# past the cached context; the cache is copied since generate extends it.
+def prepare_inputs(chat_model, prompt_input):
+    model, tokenizer = chat_model['model'], chat_model['tokenizer']
+    if chat_model['prefix_cache'] is None:
+        # Concatenate the context with the user's input
+        full_prompt = f"{CHAT_CONTEXT} {prompt_input} \nAssistant:"
+        return tokenizer([full_prompt], return_tensors="pt").to(model.device)
+    suffix_ids = tokenizer(f" {prompt_input} \nAssistant:", add_special_tokens=False, return_tensors="pt")['input_ids'].to(model.device)
+    input_ids = torch.cat([chat_model['prefix_ids'], suffix_ids], dim=1)
+    return {
+        'input_ids': input_ids,
+        'attention_mask': torch.ones_like(input_ids),
+        'past_key_values': copy.deepcopy(chat_model['prefix_cache']),
+    }
+
+# Token ids generated after the prompt, one row per prompt
+def generate_tokens(chat_model, prompt_input, max_new_tokens=CHAT_MAX_NEW_TOKENS):
+    model = chat_model['model']
+    inputs = prepare_inputs(chat_model, prompt_input)
+    with torch.inference_mode():
+        outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, use_cache=True)
+    return outputs[:, inputs['input_ids'].shape[1]:]
+
+def generate_response(chat_model, prompt_input):
+    outputs = generate_tokens(chat_model, prompt_input)
+    return chat_model['tokenizer'].batch_decode(outputs, skip_special_tokens=True)[0].strip()
+
+# Pass streamed text through, recording time to first token and total time since start
+def timed_stream(texts, start):
+    ttft = None
+    for text in texts:
+        if ttft is None and text:
+            ttft = time.perf_counter() - start
+        yield text
+    total = time.perf_counter() - start
+    # An empty response counts its whole generation time as time to first token
+    RESPONSE_TIMINGS.append({'ttft_seconds': total if ttft is None else ttft, 'total_seconds': total})
+
+# Yield the response text piece by piece as tokens are generated, for st.write_stream.
+# generate runs in its own thread and hands decoded text over through the streamer.
+# If it fails, the stream is ended and its exception is raised to the caller.
+def stream_response(chat_model, prompt_input, max_new_tokens=CHAT_MAX_NEW_TOKENS):
+    model, tokenizer = chat_model['model'], chat_model['tokenizer']
+    inputs = prepare_inputs(chat_model, prompt_input)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=CHAT_STREAM_TIMEOUT)
+    errors = []
+
+    def generate():
+        try:
+            with torch.inference_mode():
+                model.generate(**inputs, streamer=streamer, max_new_tokens=max_new_tokens, use_cache=True)
+        except Exception as e:
+            print(f"{datetime.now()}: Generation failed: {e}")
+            errors.append(e)
+            streamer.end()
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    yield from timed_stream(streamer, start)
+    thread.join()
+    if errors:
+        raise errors[0]
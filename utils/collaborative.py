@@ -0,0 +1,167 @@
+import json
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import streamlit as st
+from utils.database import fetch_data
+from utils.customer_metrics import PURCHASES_QUERY, CUSTOMER_METRICS_OVERLAP_IDS
+from utils.models import build_product_index, get_recommendations, get_batch_recommendations
+from utils.versioned_dir import current_version, new_version, exclusive_lock
+
+# Where the collaborative filtering state is kept and how often serving picks up a retrained model.
+# Each training run writes a new version directory under it, see utils.versioned_dir.
+# Training runs in the prewarm scheduler, or offline with `python -m utils.collaborative`.
+CF_MODEL_DIR = st.secrets.get('CF_MODEL_DIR', 'data/cf-model')
+CF_MODEL_TTL = int(st.secrets.get('CF_MODEL_TTL', 3600))  # Seconds
+
+CUSTOMERS_FILE = 'customers.npy'
+PRODUCTS_FILE = 'products.npy'
+INTERACTIONS_FILE = 'interactions.npz'
+COOCCURRENCE_FILE = 'cooccurrence.npz'
+WATERMARK_FILE = 'watermark.json'
+
+LAST_TRANSACTION_QUERY = "SELECT MAX(id) AS last_transaction_id FROM public.transactions;"
+
+# Customer x product matrix X (1 if the customer ever bought the product) and the
+# product x product co-purchase counts C = X^T X. The cosine similarity of two
+# products is C[i, j] / sqrt(C[i, i] * C[j, j]).
+def empty_model():
+    return {
+        'customers': pd.Index([], dtype='object'),
+        'products': pd.Index([]),
+        'interactions': sp.csr_matrix((0, 0)),
+        'cooccurrence': sp.csr_matrix((0, 0)),
+        'last_transaction_id': 0,
+    }
+
+# All files are read from the same version, resolved once
+def load_model():
+    model_dir = current_version(CF_MODEL_DIR)
+    if model_dir is None:
+        return empty_model()
+    with open(os.path.join(model_dir, WATERMARK_FILE)) as f:
+        watermark = json.load(f)
+    return {
+        'customers': pd.Index(np.load(os.path.join(model_dir, CUSTOMERS_FILE), allow_pickle=True)),
+        'products': pd.Index(np.load(os.path.join(model_dir, PRODUCTS_FILE), allow_pickle=True)),
+        'interactions': sp.load_npz(os.path.join(model_dir, INTERACTIONS_FILE)).tocsr(),
+        'cooccurrence': sp.load_npz(os.path.join(model_dir, COOCCURRENCE_FILE)).tocsr(),
+        'last_transaction_id': watermark['last_transaction_id'],
+    }
+
+# Written into a new version that replaces the current one only once every file is written
+def save_model(model):
+    with new_version(CF_MODEL_DIR) as model_dir:
+        np.save(os.path.join(model_dir, CUSTOMERS_FILE), np.array(model['customers'].tolist(), dtype='object'), allow_pickle=True)
+        np.save(os.path.join(model_dir, PRODUCTS_FILE), np.array(model['products'].tolist()), allow_pickle=True)
+        sp.save_npz(os.path.join(model_dir, INTERACTIONS_FILE), model['interactions'])
+        sp.save_npz(os.path.join(model_dir, COOCCURRENCE_FILE), model['cooccurrence'])
+        with open(os.path.join(model_dir, WATERMARK_FILE), 'w') as f:
+            json.dump({'last_transaction_id': model['last_transaction_id']}, f)
+
+# Fold new purchases into the model. Only the rows of customers who bought
+# something new are re-counted: their old contribution to C is subtracted and
+# their updated one added back.
+def update_model(model, new_purchases):
+    new_purchases = new_purchases[new_purchases['productno'].notna()]
+    customers = model['customers'].append(pd.Index(new_purchases['phone'].unique()).difference(model['customers']))
+    products = model['products'].append(pd.Index(new_purchases['productno'].unique()).difference(model['products']))
+
+    interactions = model['interactions'].copy()
+    interactions.resize((len(customers), len(products)))
+    cooccurrence = model['cooccurrence'].copy()
+    cooccurrence.resize((len(products), len(products)))
+
+    rows = customers.get_indexer(new_purchases['phone'])
+    columns = products.get_indexer(new_purchases['productno'])
+    bought = sp.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=interactions.shape)
+    affected = np.unique(rows)
+
+    old_rows = interactions[affected]
+    new_rows = ((old_rows + bought[affected]) > 0).astype('float64')
+    cooccurrence = cooccurrence - old_rows.T @ old_rows + new_rows.T @ new_rows
+    cooccurrence.eliminate_zeros()
+
+    interactions = interactions.tolil()
+    interactions[affected] = new_rows
+    return {
+        'customers': customers,
+        'products': products,
+        'interactions': interactions.tocsr(),
+        'cooccurrence': cooccurrence.tocsr(),
+        'last_transaction_id': model['last_transaction_id'],
+    }
+
+# Train on transactions ingested since the last run. Pass full=True to retrain from scratch.
+# As with the customer metrics, the stored watermark only advances to the settled
+# id (the latest one less CUSTOMER_METRICS_OVERLAP_IDS): PURCHASES_QUERY needs the
+# payment row, and ids can commit out of order, so the newest transactions are
+# read again on the next run. Interactions only record whether a customer bought
+# a product, so folding the same purchases in twice leaves the model unchanged.
+# Runs are serialized with a file lock across processes.
+def train_collaborative(full=False):
+    with exclusive_lock(CF_MODEL_DIR):
+        model = empty_model() if full else load_model()
+        since_id = model['last_transaction_id']
+        latest = fetch_data(LAST_TRANSACTION_QUERY).iloc[0]['last_transaction_id']
+        latest_id = since_id if pd.isna(latest) else int(latest)
+        settled_id = max(since_id, latest_id - CUSTOMER_METRICS_OVERLAP_IDS)
+        print(f"{datetime.now()}: Training collaborative model on transactions {since_id} to {latest_id}")
+
+        new_purchases = fetch_data(PURCHASES_QUERY, params={'since_id': since_id, 'until_id': latest_id})
+        model = update_model(model, new_purchases[['phone', 'productno']])
+        model['last_transaction_id'] = settled_id
+        save_model(model)
+        print(f"{datetime.now()}: Collaborative model has {len(model['customers'])} customers, {len(model['products'])} products "
+              f"and {model['cooccurrence'].nnz} co-purchase pairs")
+        return model
+
+# Co-purchase cosine similarity laid out in catalog order, so it can be passed
+# as cosine_sim to get_recommendations. Products nobody has bought have no
+# similarities.
+class CollaborativeSimilarity:
+    def __init__(self, cooccurrence, model_products, catalog_products):
+        self.cooccurrence = cooccurrence.tocsr()
+        self.norms = np.sqrt(self.cooccurrence.diagonal())
+        self.product_index = build_product_index(catalog_products)
+        self.shape = (len(self.product_index), len(self.product_index))
+        # Model column of every catalog product (-1 if never bought) and the reverse
+        self.model_rows = model_products.get_indexer(self.product_index)
+        self.catalog_columns = np.flatnonzero(self.model_rows >= 0)
+
+    def __getitem__(self, rows):
+        single = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        sim_rows = np.zeros((len(rows), self.shape[1]))
+        model_rows = self.model_rows[rows]
+        known = model_rows >= 0
+        if known.any():
+            counts = self.cooccurrence[model_rows[known]].toarray()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cosine = counts / np.outer(self.norms[model_rows[known]], self.norms)
+            sim_rows[np.ix_(known, self.catalog_columns)] = np.nan_to_num(cosine)[:, self.model_rows[self.catalog_columns]]
+        return sim_rows[0] if single else sim_rows
+
+    def nbytes(self):
+        return self.cooccurrence.data.nbytes + self.cooccurrence.indices.nbytes + self.cooccurrence.indptr.nbytes
+
+# Trained model served for the given catalog, shared across sessions
+@st.cache_resource(ttl=CF_MODEL_TTL)
+def get_collaborative_similarity(productnos):
+    model = load_model()
+    if not len(model['products']):
+        model = train_collaborative()
+    return CollaborativeSimilarity(model['cooccurrence'], model['products'], productnos)
+
+# Same as get_recommendations, with co-purchase similarity instead of description similarity
+def get_cf_recommendations(product_id, df, top_n=10):
+    return get_recommendations(product_id, df, cosine_sim=get_collaborative_similarity(df['productno']), top_n=top_n)
+
+def get_cf_batch_recommendations(product_ids, df, top_n=10):
+    return get_batch_recommendations(product_ids, df, cosine_sim=get_collaborative_similarity(df['productno']), top_n=top_n)
+
+if __name__ == "__main__":
+    import sys
+    train_collaborative(full='--full' in sys.argv)
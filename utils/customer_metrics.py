@@ -0,0 +1,272 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+from utils.database import fetch_data
+
+# Where the per-customer aggregate state is kept and how often it is brought up to date
+CUSTOMER_METRICS_DIR = st.secrets.get('CUSTOMER_METRICS_DIR', 'data/customer_metrics')
+CUSTOMER_METRICS_TTL = int(st.secrets.get('CUSTOMER_METRICS_TTL', 3600))  # Seconds
+# Rows can become visible after rows past them were already read: a transaction
+# whose payment is committed later, or a lower id committed after a higher one.
+# The newest transactions and payments are therefore re-read on every refresh
+# and only folded into the stored state once they are this far behind the latest.
+# Rows showing up later than that are only picked up by a --full rebuild.
+CUSTOMER_METRICS_OVERLAP_IDS = int(st.secrets.get('CUSTOMER_METRICS_OVERLAP_IDS', 10000))
+CUSTOMER_METRICS_OVERLAP_HOURS = int(st.secrets.get('CUSTOMER_METRICS_OVERLAP_HOURS', 24))
+
+# The state lives in a directory per refresh; CURRENT_PATH is a symlink to the
+# latest one, swapped in one os.replace so readers never see a partial update
+CURRENT_PATH = os.path.join(CUSTOMER_METRICS_DIR, 'current')
+LOCK_PATH = os.path.join(CUSTOMER_METRICS_DIR, 'refresh.lock')
+PURCHASES_FILE = 'purchases.parquet'
+PAYMENTS_FILE = 'payments.parquet'
+SNAPSHOT_FILE = 'snapshot.parquet'
+WATERMARKS_FILE = 'watermarks.json'
+SNAPSHOT_PATH = os.path.join(CURRENT_PATH, SNAPSHOT_FILE)
+
+INITIAL_WATERMARKS = {'last_transaction_id': 0, 'last_payment_datein': '1900-01-01 00:00:00'}
+
+WATERMARKS_QUERY = """
+SELECT
+    (SELECT MAX(id) FROM public.transactions) AS last_transaction_id,
+    (SELECT MAX(datein) FROM public.payment) AS last_payment_datein;
+"""
+
+# Purchase lines of transactions in (since_id, until_id], aggregated per customer and product.
+# Only transactions with a payment are included.
+PURCHASES_QUERY = """
+SELECT
+    pay.phone,
+    c.cname AS customer_name,
+    td.productno,
+    p.description AS product_description,
+    COUNT(td.productno) AS purchase_count,
+    MIN(t.datein) AS first_purchase_date,
+    MAX(t.datein) AS last_purchase_date,
+    SUM(t.totalamount) AS total_spent
+FROM
+    public.transactiondetails td
+JOIN
+    public.transactions t ON td.transactionid = t.id
+JOIN
+    public.payment pay ON t.invoiceno = pay.invoiceno::text
+LEFT JOIN
+    public.customers c ON pay.custid = c.custid
+LEFT JOIN
+    public.product p ON td.productno = p.productno
+WHERE
+    pay.phone IS NOT NULL AND pay.phone <> ''
+    AND t.id > :since_id AND t.id <= :until_id
+GROUP BY
+    pay.phone, c.cname, td.productno, p.description;
+"""
+
+# Payments dated in (since_date, until_date], aggregated per customer
+PAYMENTS_QUERY = """
+SELECT
+    pay.phone,
+    c.cname AS customer_name,
+    COUNT(DISTINCT pay.paymentid) AS total_payments,
+    SUM(pay.amount) AS total_paid,
+    MIN(pay.datein) AS first_payment_date,
+    MAX(pay.datein) AS last_payment_date,
+    MAX(c.address) AS address,
+    MAX(c.email) AS email,
+    MAX(c.creditlimit) AS creditlimit,
+    MAX(c.balance) AS balance,
+    MAX(c.loyaltypoints) AS loyaltypoints,
+    MAX(c.loyalty_number) AS loyalty_number,
+    MAX(c.autodiscount) AS autodiscount
+FROM
+    public.payment pay
+JOIN
+    public.customers c ON pay.custid = c.custid
+WHERE
+    pay.phone IS NOT NULL AND pay.phone <> ''
+    AND pay.datein > :since_date AND pay.datein <= :until_date
+GROUP BY
+    pay.phone, c.cname;
+"""
+
+CUSTOMER_ATTRIBUTES = ['address', 'email', 'creditlimit', 'balance', 'loyaltypoints', 'loyalty_number', 'autodiscount']
+
+SNAPSHOT_COLUMNS = [
+    'phone',
+    'customer_name',
+    'total_payments',
+    'total_paid',
+    'first_payment_date',
+    'last_payment_date',
+    'total_purchases',
+    'first_purchase_date',
+    'last_purchase_date',
+    'total_spent',
+    'top_productno',
+    'most_purchased_item',
+    'most_purchased_item_count',
+] + CUSTOMER_ATTRIBUTES
+
+# Watermarks and running state of the current refresh, all read from the same directory
+def load_state():
+    if not os.path.exists(os.path.join(CURRENT_PATH, WATERMARKS_FILE)):
+        return dict(INITIAL_WATERMARKS), pd.DataFrame(), pd.DataFrame()
+    state_dir = os.path.realpath(CURRENT_PATH)
+    with open(os.path.join(state_dir, WATERMARKS_FILE)) as f:
+        watermarks = json.load(f)
+    return watermarks, pd.read_parquet(os.path.join(state_dir, PURCHASES_FILE)), pd.read_parquet(os.path.join(state_dir, PAYMENTS_FILE))
+
+# Write a new state directory and switch CURRENT_PATH to it. The previous one is
+# kept for readers that resolved the link just before the switch, older ones are dropped.
+def save_state(watermarks, purchases, payments, snapshot):
+    previous_dir = os.path.basename(os.path.realpath(CURRENT_PATH))
+    state_dir = tempfile.mkdtemp(prefix='state-', dir=CUSTOMER_METRICS_DIR)
+    purchases.to_parquet(os.path.join(state_dir, PURCHASES_FILE), index=False)
+    payments.to_parquet(os.path.join(state_dir, PAYMENTS_FILE), index=False)
+    snapshot.to_parquet(os.path.join(state_dir, SNAPSHOT_FILE), index=False)
+    with open(os.path.join(state_dir, WATERMARKS_FILE), 'w') as f:
+        json.dump(watermarks, f)
+    link = f"{CURRENT_PATH}.{os.getpid()}.tmp"
+    os.symlink(os.path.basename(state_dir), link)
+    os.replace(link, CURRENT_PATH)
+    for name in os.listdir(CUSTOMER_METRICS_DIR):
+        if name.startswith('state-') and name not in (os.path.basename(state_dir), previous_dir):
+            shutil.rmtree(os.path.join(CUSTOMER_METRICS_DIR, name), ignore_errors=True)
+
+# Fold newly ingested purchase lines into the running per customer/product counts
+def merge_purchases(purchases, new_purchases):
+    # Concatenating an empty frame would turn the count columns into objects
+    if purchases.empty:
+        return new_purchases
+    if new_purchases.empty:
+        return purchases
+    combined = pd.concat([purchases, new_purchases], ignore_index=True)
+    return combined.groupby(['phone', 'customer_name', 'productno', 'product_description'], dropna=False).agg(
+        purchase_count=('purchase_count', 'sum'),
+        first_purchase_date=('first_purchase_date', 'min'),
+        last_purchase_date=('last_purchase_date', 'max'),
+        total_spent=('total_spent', 'sum'),
+    ).reset_index()
+
+# Fold newly ingested payments into the running per customer totals
+def merge_payments(payments, new_payments):
+    if payments.empty:
+        return new_payments
+    if new_payments.empty:
+        return payments
+    combined = pd.concat([payments, new_payments], ignore_index=True)
+    aggregations = {
+        'total_payments': ('total_payments', 'sum'),
+        'total_paid': ('total_paid', 'sum'),
+        'first_payment_date': ('first_payment_date', 'min'),
+        'last_payment_date': ('last_payment_date', 'max'),
+    }
+    # Customer attributes are taken from the most recent batch
+    aggregations.update({column: (column, 'last') for column in CUSTOMER_ATTRIBUTES})
+    return combined.groupby(['phone', 'customer_name']).agg(**aggregations).reset_index()
+
+# Derive the per-customer snapshot from the running purchase and payment state
+def build_snapshot(purchases, payments):
+    customer_purchases = purchases.groupby(['phone', 'customer_name']).agg(
+        total_purchases=('purchase_count', 'sum'),
+        first_purchase_date=('first_purchase_date', 'min'),
+        last_purchase_date=('last_purchase_date', 'max'),
+        total_spent=('total_spent', 'sum'),
+    ).reset_index()
+    product_counts = purchases[purchases['product_description'].notna()].groupby(
+        ['phone', 'productno', 'product_description']
+    )['purchase_count'].sum().reset_index()
+    top_items = product_counts.sort_values('purchase_count', ascending=False).drop_duplicates('phone').rename(columns={
+        'productno': 'top_productno',
+        'product_description': 'most_purchased_item',
+        'purchase_count': 'most_purchased_item_count',
+    })
+    df = payments.merge(customer_purchases, on=['phone', 'customer_name'], how='left')
+    df = df.merge(top_items, on='phone', how='left')
+    return df[SNAPSHOT_COLUMNS]
+
+# Bring the aggregates up to date, fetching only rows past the stored watermarks.
+# Rows up to the settled watermarks (the latest ones less the overlap) are folded
+# into the stored state; the newer ones are fetched again on every refresh and
+# only go into the snapshot. Pass full=True to discard the state and recompute
+# everything from scratch. Refreshes are serialized with a file lock across
+# processes; with max_age, a refresh that waited for another one returns that
+# one's snapshot if it is younger than max_age seconds.
+def refresh_customer_metrics(full=False, max_age=None):
+    os.makedirs(CUSTOMER_METRICS_DIR, exist_ok=True)
+    with open(LOCK_PATH, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if max_age is not None and not full and os.path.exists(SNAPSHOT_PATH) and time.time() - os.path.getmtime(SNAPSHOT_PATH) < max_age:
+            return pd.read_parquet(SNAPSHOT_PATH)
+
+        watermarks, purchases, payments = (dict(INITIAL_WATERMARKS), pd.DataFrame(), pd.DataFrame()) if full else load_state()
+        print(f"{datetime.now()}: Refreshing customer metrics from {watermarks}")
+
+        latest = fetch_data(WATERMARKS_QUERY).iloc[0]
+        latest_id = watermarks['last_transaction_id'] if pd.isna(latest['last_transaction_id']) else int(latest['last_transaction_id'])
+        latest_date = watermarks['last_payment_datein'] if pd.isna(latest['last_payment_datein']) else str(latest['last_payment_datein'])
+        settled_id = max(watermarks['last_transaction_id'], latest_id - CUSTOMER_METRICS_OVERLAP_IDS)
+        settled_date = str(max(
+            pd.Timestamp(watermarks['last_payment_datein']),
+            pd.Timestamp(latest_date) - pd.Timedelta(hours=CUSTOMER_METRICS_OVERLAP_HOURS),
+        ))
+
+        new_purchases = fetch_data(PURCHASES_QUERY, params={'since_id': watermarks['last_transaction_id'], 'until_id': settled_id})
+        new_payments = fetch_data(PAYMENTS_QUERY, params={'since_date': watermarks['last_payment_datein'], 'until_date': settled_date})
+        recent_purchases = fetch_data(PURCHASES_QUERY, params={'since_id': settled_id, 'until_id': latest_id})
+        recent_payments = fetch_data(PAYMENTS_QUERY, params={'since_date': settled_date, 'until_date': latest_date})
+        print(f"{datetime.now()}: Ingested {len(new_purchases)} purchase groups and {len(new_payments)} payment groups, "
+              f"{len(recent_purchases)} and {len(recent_payments)} more within the overlap")
+
+        purchases = merge_purchases(purchases, new_purchases)
+        payments = merge_payments(payments, new_payments)
+        df = build_snapshot(merge_purchases(purchases, recent_purchases), merge_payments(payments, recent_payments))
+        save_state({'last_transaction_id': settled_id, 'last_payment_datein': settled_date}, purchases, payments, df)
+        return df
+
+# Cached per state directory, so a refresh swaps the new snapshot in without a cold cache
+@st.cache_data(max_entries=2)
+def read_customer_metrics(snapshot_path):
+    df = pd.read_parquet(snapshot_path)
+    for column in ['first_payment_date', 'last_payment_date', 'first_purchase_date', 'last_purchase_date']:
+        df[column] = pd.to_datetime(df[column])
+    return df
+
+# Serve the snapshot, bringing it up to date once it is older than CUSTOMER_METRICS_TTL
+def load_customer_metrics():
+    if not os.path.exists(SNAPSHOT_PATH) or time.time() - os.path.getmtime(SNAPSHOT_PATH) >= CUSTOMER_METRICS_TTL:
+        refresh_customer_metrics(max_age=CUSTOMER_METRICS_TTL)
+    return read_customer_metrics(os.path.realpath(SNAPSHOT_PATH))
+
+# Customers that have at least one purchase line
+def get_purchasing_customers():
+    df = load_customer_metrics()
+    df = df[df['total_purchases'].notna()].copy()
+    df['purchase_duration_days'] = (df['last_purchase_date'] - df['first_purchase_date']).dt.days
+    return df
+
+# Purchasing customers ranked by total spent, as used for training the sales model
+def fetch_sales_data():
+    df = get_purchasing_customers()[[
+        'phone',
+        'customer_name',
+        'total_purchases',
+        'first_purchase_date',
+        'last_purchase_date',
+        'total_spent',
+        'most_purchased_item',
+        'most_purchased_item_count',
+        'purchase_duration_days',
+    ]].sort_values('total_spent', ascending=False).reset_index(drop=True)
+    print("\nData Queried:\n")
+    print(df)
+    return df
+
+if __name__ == "__main__":
+    import sys
+    refresh_customer_metrics(full='--full' in sys.argv)
@@ -0,0 +1,14 @@
+# "phone · name" label of every customer (the phone number alone when there is no
+# name), keyed by phone number in phone order. A select box over these labels
+# filters by any part of the phone number or name while the user types.
+def build_customer_labels(customers):
+    labels = {}
+    for phone, name in zip(customers['phone'], customers['customer_name']):
+        if not isinstance(phone, str) or not phone.strip():
+            continue
+        # The first name seen for a phone number is kept
+        if isinstance(name, str) and name.strip() and labels.get(phone, phone) == phone:
+            labels[phone] = f"{phone} · {name}"
+        else:
+            labels.setdefault(phone, phone)
+    return dict(sorted(labels.items()))
@@ -0,0 +1,125 @@
+from utils.cache import result_cache
+from utils.database import fetch_data
+
+# Dashboard queries live here rather than in the page scripts so the prewarm
+# scheduler (utils/prewarm.py) fills the same cache entries the pages read
+
+# Function to fetch top 10 most purchased items
+@result_cache()
+def get_top_10_items():
+    query = """
+    SELECT
+        p.description AS product_description,
+        COUNT(td.productno) AS purchase_count
+    FROM
+        public.transactiondetails td
+    JOIN
+        public.product p ON td.productno = p.productno
+    GROUP BY
+        p.description
+    ORDER BY
+        purchase_count DESC
+    LIMIT 10;
+    """
+    return fetch_data(query)
+
+# Function to fetch credit account most purchased items
+@result_cache()
+def get_credit_account_most_purchased():
+    query = """
+    WITH customer_purchases AS (
+        SELECT
+            c.custid,
+            c.cname,
+            c.phone,
+            td.productno,
+            p.description,
+            COUNT(td.productno) AS purchase_count
+        FROM
+            public.customers c
+        JOIN
+            public.transactiondetails td ON c.custid = td.customerid
+        JOIN
+            public.product p ON td.productno = p.productno
+        GROUP BY
+            c.custid, c.cname, td.productno, p.description, c.phone
+    ),
+    ranked_purchases AS (
+        SELECT
+            cp.*,
+            ROW_NUMBER() OVER (PARTITION BY cp.custid ORDER BY cp.purchase_count DESC) AS rank
+        FROM
+            customer_purchases cp
+    )
+    SELECT
+        custid,
+        cname,
+        phone,
+        description,
+        purchase_count,
+        productno
+    FROM
+        ranked_purchases
+    WHERE
+        rank = 1
+    ORDER BY
+        custid;
+    """
+    return fetch_data(query)
+
+# Function to fetch items purchased less than 20 times
+@result_cache()
+def get_items_purchased_less_than_20():
+    query = """
+    WITH product_purchases AS (
+        SELECT
+            td.productno,
+            p.description,
+            COUNT(td.productno) AS purchase_count
+        FROM
+            public.transactiondetails td
+        JOIN
+            public.product p ON td.productno = p.productno
+        GROUP BY
+            td.productno, p.description
+    )
+    SELECT
+        productno,
+        description,
+        purchase_count
+    FROM
+        product_purchases
+    WHERE
+        purchase_count < 20
+    ORDER BY
+        purchase_count;
+    """
+    return fetch_data(query)
+
+# Function to fetch least purchased items
+@result_cache()
+def get_least_purchased_items():
+    query = """
+    WITH product_purchases AS (
+        SELECT
+            td.productno,
+            p.description,
+            COUNT(td.productno) AS purchase_count
+        FROM
+            public.transactiondetails td
+        JOIN
+            public.product p ON td.productno = p.productno
+        GROUP BY
+            td.productno, p.description
+    )
+    SELECT
+        productno,
+        description,
+        purchase_count
+    FROM
+        product_purchases
+    ORDER BY
+        purchase_count ASC
+    LIMIT 100;
+    """
+    return fetch_data(query)
@@ -1,8 +1,15 @@
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, text
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from datetime import datetime
+import os
+import re
+import threading
 import time
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Load environment variables
 DB_HOST = st.secrets['DB_HOST']
@@ -12,24 +19,191 @@ DB_USER = st.secrets['DB_USER']
 DB_PASSWORD = st.secrets['DB_PASSWORD']
 SSL_CERT_PATH = st.secrets['SSL_CERT_PATH']
 
+# Connection pool settings (optional, fall back to sensible defaults)
+DB_POOL_SIZE = int(st.secrets.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(st.secrets.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(st.secrets.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(st.secrets.get('DB_POOL_RECYCLE', 1800))  # Seconds before a connection is replaced
+DB_POOL_PRE_PING = bool(st.secrets.get('DB_POOL_PRE_PING', True))
+
+# Read results through COPY into Arrow instead of row by row through pd.read_sql
+DB_ARROW_FETCH = bool(st.secrets.get('DB_ARROW_FETCH', True))
+
 # Create connection string
 DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require'
 print(f"\n\n{datetime.now()}:  DATABASE_URL = {DATABASE_URL}\n\n")
 
+# One pooled engine per process, shared by every session and page
+@st.cache_resource
 def connect_to_db():
     print(f"{datetime.now()}: Connecting to the Database and creating Engine")
-    return create_engine(DATABASE_URL, 
+    return create_engine(DATABASE_URL,
+                         pool_size=DB_POOL_SIZE,
+                         max_overflow=DB_MAX_OVERFLOW,
+                         pool_timeout=DB_POOL_TIMEOUT,
+                         pool_recycle=DB_POOL_RECYCLE,
+                         pool_pre_ping=DB_POOL_PRE_PING,
                          connect_args={
                              'connect_timeout': 10,  # Increase timeout
                              'sslrootcert': SSL_CERT_PATH
                          })
 
-def fetch_data(query, retries=5, delay=5):
-    print(f"{datetime.now()}: Running Query:{query}")
-    connection = connect_to_db()
+# Current connection pool statistics, for monitoring
+def get_pool_status():
+    pool = connect_to_db().pool
+    return {
+        'pool_size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'status': pool.status(),
+    }
+
+# Matches :name bound parameters, but not ::type casts
+PARAM_PATTERN = re.compile(r'(?<![:\w]):(\w+)')
+
+# Postgres type OIDs read back from CSV with an explicit Arrow type, so that
+# e.g. phone numbers keep their leading zeros instead of being inferred as ints,
+# booleans are parsed from COPY's t/f and empty results keep their column types
+ARROW_COLUMN_TYPES = {
+    16: pa.bool_(),  # bool
+    20: pa.int64(),  # int8
+    21: pa.int16(),  # int2
+    23: pa.int32(),  # int4
+    700: pa.float32(),  # float4
+    701: pa.float64(),  # float8
+    1700: pa.float64(),  # numeric, as pd.read_sql's coerce_float does
+    18: pa.string(),  # char
+    25: pa.string(),  # text
+    1042: pa.string(),  # bpchar
+    1043: pa.string(),  # varchar
+    1082: pa.date32(),  # date
+    1114: pa.timestamp('us'),  # timestamp
+    1184: pa.timestamp('us', tz='UTC'),  # timestamptz
+}
+
+# Run a query with COPY ... TO STDOUT and parse the CSV stream with pyarrow.
+# COPY writes into an OS pipe from its own thread while pyarrow parses the other
+# end block by block, so the CSV text is never held in memory as a whole.
+# Strings come back as Arrow-backed columns, other types as regular numpy columns.
+# COPY cannot take bind parameters, so :name parameters are quoted and inlined
+# into the SQL text client side by psycopg2 (literal % signs are escaped first).
+def read_arrow(query, connection, params=None):
+    with connection.connection.cursor() as cursor:
+        if params is not None:
+            query = cursor.mogrify(PARAM_PATTERN.sub(r'%(\1)s', query.replace('%', '%%')), params).decode()
+        query = query.strip().rstrip(';')
+        cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0")
+        # Types are fixed up front since a streaming reader cannot revise a type
+        # inferred from the first block; other types are read as text
+        column_types = {
+            column.name: ARROW_COLUMN_TYPES.get(column.type_code, pa.string())
+            for column in cursor.description
+        }
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def copy():
+            try:
+                with open(write_fd, 'wb') as writer:
+                    cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT CSV, HEADER)", writer)
+            except BrokenPipeError:
+                pass  # The reader stopped on an error of its own, raised below
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=copy, daemon=True)
+        thread.start()
+        try:
+            with open(read_fd, 'rb') as reader:
+                batches = pa_csv.open_csv(reader, convert_options=pa_csv.ConvertOptions(
+                    column_types=column_types,
+                    true_values=['t'],
+                    false_values=['f'],
+                    strings_can_be_null=True,  # Unquoted empty fields are NULLs
+                    quoted_strings_can_be_null=False,  # Quoted empty fields are empty strings
+                ))
+                table = pa.Table.from_batches(list(batches), schema=batches.schema)
+        finally:
+            thread.join()
+            # A failed COPY ends the stream early, its error is the one that matters
+            if errors:
+                raise errors[0]
+    return table.to_pandas(types_mapper={pa.string(): pd.ArrowDtype(pa.string())}.get)
+
+def fetch_data(query, params=None, retries=5, delay=5):
+    print(f"{datetime.now()}: Running Query:{query} Params:{params}")
+    engine = connect_to_db()
+    for attempt in range(retries):
+        try:
+            with engine.connect() as connection:
+                if DB_ARROW_FETCH:
+                    df = read_arrow(query, connection, params=params)
+                else:
+                    df = pd.read_sql(query if params is None else text(query), connection, params=params)
+            return df
+        except Exception as e:  # Catch all exceptions
+            print(f"Attempt {attempt + 1} failed with error: {e}")
+            if attempt < retries - 1:
+                time.sleep(delay)
+            else:
+                raise  # Re-raise the last exception if retries are exhausted
+
+# Stream a query as DataFrame chunks over a server-side cursor, so at most
+# chunksize rows are held in memory at once. Combine the chunks with the
+# reducers below (sum_chunks, resample_chunks, groupby_chunks).
+def fetch_data_chunks(query, params=None, chunksize=50000):
+    print(f"{datetime.now()}: Streaming Query:{query} Params:{params} Chunksize:{chunksize}")
+    engine = connect_to_db()
+    if params is not None:
+        query = text(query)
+    with engine.connect().execution_options(stream_results=True) as connection:
+        for chunk in pd.read_sql(query, connection, params=params, chunksize=chunksize):
+            yield chunk
+
+# Reducers for DataFrame chunks (see fetch_data_chunks).
+# Each chunk is reduced on its own and the partial results are combined,
+# so only one chunk plus the partial results are in memory at any time.
+# Only decomposable aggregations are supported; 'count' partials are summed.
+CHUNK_COMBINERS = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+
+def sum_chunks(chunks, columns):
+    total = pd.Series(0, index=columns, dtype='float64')
+    for chunk in chunks:
+        total = total + chunk[columns].sum()
+    return total
+
+def resample_chunks(chunks, rule, columns, agg='sum'):
+    partials = [chunk[columns].resample(rule).agg(agg) for chunk in chunks if not chunk.empty]
+    if not partials:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(partials).resample(rule).agg(CHUNK_COMBINERS[agg])
+
+def groupby_chunks(chunks, by, columns, agg='sum'):
+    partials = [chunk.groupby(by, dropna=False)[columns].agg(agg) for chunk in chunks if not chunk.empty]
+    if not partials:
+        return pd.DataFrame(columns=columns)
+    combined = pd.concat(partials)
+    return combined.groupby(level=list(range(combined.index.nlevels)), dropna=False).agg(CHUNK_COMBINERS[agg])
+
+# Run a query with :name parameters as a server-side prepared statement.
+# The statement is PREPAREd once per pooled connection and EXECUTEd afterwards,
+# so repeated lookups reuse the plan instead of being parsed and planned again.
+def fetch_prepared(name, query, params, retries=5, delay=5):
+    print(f"{datetime.now()}: Running Prepared Query:{name} Params:{params}")
+    param_names = list(dict.fromkeys(PARAM_PATTERN.findall(query)))
+    positional_query = PARAM_PATTERN.sub(lambda m: f"${param_names.index(m.group(1)) + 1}", query.strip().rstrip(';'))
+    execute = text(f"EXECUTE {name}({', '.join(':' + p for p in param_names)})" if param_names else f"EXECUTE {name}")
+    engine = connect_to_db()
     for attempt in range(retries):
         try:
-            df = pd.read_sql(query, connection)
+            with engine.connect() as connection:
+                # Prepared statements live as long as the underlying DBAPI connection
+                prepared = connection.connection.info.setdefault('prepared_statements', set())
+                if name not in prepared:
+                    connection.exec_driver_sql(f"PREPARE {name} AS {positional_query}")
+                    prepared.add(name)
+                df = pd.read_sql(execute, connection, params=params)
             return df
         except Exception as e:  # Catch all exceptions
             print(f"Attempt {attempt + 1} failed with error: {e}")
@@ -38,86 +212,54 @@ def fetch_data(query, retries=5, delay=5):
             else:
                 raise  # Re-raise the last exception if retries are exhausted
 
-def fetch_sales_data():
-    query = """
-    WITH customer_purchase_counts AS (
-        SELECT
-            pay.phone,
-            c.cname AS customer_name,
-            COUNT(td.productno) AS total_purchases,
-            MIN(t.datein) AS first_purchase_date,
-            MAX(t.datein) AS last_purchase_date,
-            SUM(t.totalamount) AS total_spent
-        FROM
-            public.transactiondetails td
-        JOIN
-            public.transactions t ON td.transactionid = t.id
-        JOIN
-            public.payment pay ON t.invoiceno = pay.invoiceno::text
-        JOIN
-            public.customers c ON pay.custid = c.custid
-        WHERE
-            pay.phone IS NOT NULL AND pay.phone <> ''
-        GROUP BY
-            pay.phone, c.cname
-    ),
-    most_purchased_items AS (
-        SELECT
-            pay.phone,
-            td.productno,
-            p.description AS product_description,
-            COUNT(td.productno) AS purchase_count
-        FROM
-            public.transactiondetails td
-        JOIN
-            public.transactions t ON td.transactionid = t.id
-        JOIN
-            public.payment pay ON t.invoiceno = pay.invoiceno::text
-        JOIN
-            public.product p ON td.productno = p.productno
-        WHERE
-            pay.phone IS NOT NULL AND pay.phone <> ''
-        GROUP BY
-            pay.phone, td.productno, p.description
-    ),
-    ranked_items AS (
-        SELECT
-            phone,
-            productno,
-            product_description,
-            purchase_count,
-            ROW_NUMBER() OVER (PARTITION BY phone ORDER BY purchase_count DESC) AS rn
-        FROM
-            most_purchased_items
-    ),
-    most_purchased_items_with_count AS (
-        SELECT
-            ri.phone,
-            ri.product_description AS most_purchased_item,
-            ri.purchase_count AS most_purchased_item_count
-        FROM
-            ranked_items ri
-        WHERE
-            ri.rn = 1
-    )
+# Run independent fetches at the same time, each on its own pooled connection,
+# so a page waits for the slowest query instead of the sum of all of them.
+# Takes {name: function} with functions called without arguments (use lambdas or
+# functools.partial for parameters) and returns {name: result} in the same order.
+# At most DB_POOL_SIZE run at once so a page never dips into the overflow connections.
+def fetch_parallel(fetches, max_workers=None):
+    ctx = get_script_run_ctx()
+
+    # Worker threads share the page's script context so st.cache_data and friends work in them
+    def run(fetch):
+        add_script_run_ctx(ctx=ctx)
+        return fetch()
+
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(fetches), DB_POOL_SIZE) or 1) as executor:
+        futures = {name: executor.submit(run, fetch) for name, fetch in fetches.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+# Period label expressions matching pandas resample rules. Weekly periods run
+# Tuesday to Monday and are labelled by the Monday, like resample('W-MON').
+SALES_ROLLUP_PERIODS = {
+    'D': "date_trunc('day', datein)",
+    'W-MON': "date_trunc('week', datein - interval '1 day') + interval '7 days'",
+    'MS': "date_trunc('month', datein)",
+}
+
+# Total payment amount per period, aggregated in Postgres for the days from
+# start_date to end_date inclusive and excluding the given customers.
+# Empty periods are filled with 0.
+def fetch_sales_rollup(freq, start_date, end_date, excluded_customer_ids=()):
+    query = f"""
     SELECT
-        cpc.phone,
-        cpc.customer_name,
-        cpc.total_purchases,
-        cpc.first_purchase_date,
-        cpc.last_purchase_date,
-        cpc.total_spent,
-        mpi.most_purchased_item,
-        mpi.most_purchased_item_count,
-        DATE_PART('day', cpc.last_purchase_date - cpc.first_purchase_date) AS purchase_duration_days
+        {SALES_ROLLUP_PERIODS[freq]} AS period,
+        SUM(amount) AS amount
     FROM
-        customer_purchase_counts cpc
-    LEFT JOIN
-        most_purchased_items_with_count mpi ON cpc.phone = mpi.phone
+        public.payment
+    WHERE
+        datein >= '2019-01-01'
+        AND datein >= :start_date AND datein < CAST(:end_date AS date) + 1
+        AND (custid IS NULL OR NOT custid = ANY(:excluded_customer_ids))
+    GROUP BY
+        period
     ORDER BY
-        cpc.total_spent DESC;
+        period;
     """
-    df = fetch_data(query)
-    print("\nData Queried:\n")
-    print(df)
-    return df
+    df = fetch_data(query, params={
+        'start_date': start_date,
+        'end_date': end_date,
+        'excluded_customer_ids': list(excluded_customer_ids),
+    })
+    df['period'] = pd.to_datetime(df['period'])
+    return df.set_index('period').rename_axis('datein')[['amount']].asfreq(freq, fill_value=0)
@@ -1,22 +1,205 @@
+import hashlib
+import os
+import numpy as np
 import pandas as pd
 import joblib
+import scipy.sparse as sp
 import streamlit as st
+from utils.ann import LSHIndex
+from utils.versioned_dir import current_version, new_version, exclusive_lock
 
-cosine_sim = joblib.load(st.secrets["CBF_MODEL_PATH"])
-                    
-def get_recommendations(product_id, df, cosine_sim=cosine_sim):
-    try:
-        idx = df[df['productno'] == product_id].index[0]
-    except IndexError:
-        print(f"Product with ID {product_id} not found in the dataset.")
-        return pd.DataFrame()
+# TF-IDF vectorizer fitted on product descriptions, similarities are computed from it on demand
+TFIDF_MODEL_PATH = st.secrets.get("TFIDF_MODEL_PATH", "models/cbf-model/tfidf_vectorizer.pkl")
+# Keep only this many neighbours per product instead of computing exact rows (0 = exact)
+CBF_NEIGHBORS = int(st.secrets.get("CBF_NEIGHBORS", 0))
+# Memory-mapped similarity artifacts, shared through the OS page cache by all worker processes.
+# Each build is a new version directory under it, see utils.versioned_dir.
+CBF_ARTIFACTS_DIR = st.secrets.get("CBF_ARTIFACTS_DIR", "data/cbf-model")
+# Serve recommendations from an approximate nearest neighbour index instead of exact rows
+CBF_ANN = bool(st.secrets.get("CBF_ANN", False))
+ANN_TABLES = int(st.secrets.get("ANN_TABLES", 16))
+ANN_BITS = int(st.secrets.get("ANN_BITS", 10))
+ANN_PROBES = int(st.secrets.get("ANN_PROBES", 2))
 
-    sim_scores = list(enumerate(cosine_sim[idx]))
-    sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
-    sim_scores = sim_scores[1:11]  # Get top 10 recommendations
-    
-    product_indices = [i[0] for i in sim_scores]
-    
+# Loaded on the first recommendation request rather than at import
+@st.cache_resource
+def get_tfidf_vectorizer():
+    return joblib.load(TFIDF_MODEL_PATH)
+
+# Indices of the k highest scores in each row, best first, skipping each row's own product.
+# argpartition selects the top k in linear time, only those k are then sorted.
+def top_k_similar(sim_rows, exclude, k=10):
+    sim_rows = np.array(sim_rows, dtype='float64', ndmin=2)
+    exclude = np.atleast_1d(exclude)
+    sim_rows[np.arange(len(exclude)), exclude] = -np.inf
+    k = min(k, sim_rows.shape[1] - 1)
+    if k <= 0:
+        return np.empty((len(sim_rows), 0), dtype='int64')
+    top = np.argpartition(-sim_rows, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(sim_rows, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+# Multiplying by the transpose of the few query rows keeps the big matrix in CSR,
+# instead of scipy converting (and copying) the whole of tfidf_matrix.T per query
+def exact_similarity_rows(tfidf_matrix, rows):
+    return (tfidf_matrix @ tfidf_matrix[rows].T).T.toarray()
+
+# Top k neighbours of every product, computed in batches of rows
+def nearest_neighbors(tfidf_matrix, k, batch_size=1024):
+    indices, scores = [], []
+    for start in range(0, tfidf_matrix.shape[0], batch_size):
+        rows = np.arange(start, min(start + batch_size, tfidf_matrix.shape[0]))
+        sim_rows = exact_similarity_rows(tfidf_matrix, rows)
+        top = top_k_similar(sim_rows, rows, k=k)
+        indices.append(top)
+        scores.append(np.take_along_axis(sim_rows, top, axis=1))
+    return np.vstack(indices), np.vstack(scores)
+
+# Stands in for the dense N x N cosine_sim matrix: indexing it with one or more
+# row positions returns those rows of cosine similarities, computed on demand as
+# a sparse dot product of L2-normalised TF-IDF vectors. When neighbour lists are
+# given only those similarities are kept and the others read as 0.
+class SparseSimilarity:
+    def __init__(self, tfidf_matrix, neighbor_indices=None, neighbor_scores=None):
+        self.tfidf_matrix = tfidf_matrix
+        self.shape = (tfidf_matrix.shape[0], tfidf_matrix.shape[0])
+        self.neighbor_indices = neighbor_indices
+        self.neighbor_scores = neighbor_scores
+
+    def __getitem__(self, rows):
+        single = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        if self.neighbor_indices is None:
+            sim_rows = exact_similarity_rows(self.tfidf_matrix, rows)
+        else:
+            sim_rows = np.zeros((len(rows), self.shape[1]))
+            np.put_along_axis(sim_rows, self.neighbor_indices[rows], self.neighbor_scores[rows], axis=1)
+        return sim_rows[0] if single else sim_rows
+
+def artifact_path(version_dir, name):
+    return os.path.join(version_dir, f"{name}.npy")
+
+# productno -> matrix row, looked up in O(1) through a hash-based pandas Index
+def build_product_index(productnos):
+    product_index = pd.Index(productnos)
+    if product_index.has_duplicates:
+        raise ValueError(f"Duplicate product numbers in the catalog: {product_index[product_index.duplicated()].unique().tolist()}")
+    return product_index
+
+# Identifies the catalog (products and their order) and settings the artifacts were built for
+def catalog_fingerprint(products):
+    digest = hashlib.sha1()
+    for productno, description in zip(products['productno'], products['description']):
+        digest.update(f"{productno}\x1f{description}\x1e".encode('utf-8'))
+    digest.update(f"neighbors={CBF_NEIGHBORS}".encode('utf-8'))
+    return digest.hexdigest()
+
+def read_fingerprint(version_dir):
+    if version_dir is None:
+        return None
+    path = os.path.join(version_dir, 'fingerprint.txt')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+# Vectorize the catalog and write the TF-IDF matrix, the productno of every
+# matrix row (and the neighbour lists) as .npy files into a new version, which
+# replaces the current one only once every file is written
+def save_similarity_artifacts(products):
+    print(f"Building similarity artifacts for {len(products)} products in {CBF_ARTIFACTS_DIR}")
+    tfidf_matrix = sp.csr_matrix(get_tfidf_vectorizer().transform(products['description']))
+    with new_version(CBF_ARTIFACTS_DIR) as version_dir:
+        np.save(artifact_path(version_dir, 'productnos'), np.array(products['productno'].tolist()))
+        np.save(artifact_path(version_dir, 'tfidf_data'), tfidf_matrix.data)
+        np.save(artifact_path(version_dir, 'tfidf_indices'), tfidf_matrix.indices)
+        np.save(artifact_path(version_dir, 'tfidf_indptr'), tfidf_matrix.indptr)
+        np.save(artifact_path(version_dir, 'tfidf_shape'), np.array(tfidf_matrix.shape))
+        if CBF_NEIGHBORS:
+            neighbor_indices, neighbor_scores = nearest_neighbors(tfidf_matrix, CBF_NEIGHBORS)
+            np.save(artifact_path(version_dir, 'neighbor_indices'), neighbor_indices)
+            np.save(artifact_path(version_dir, 'neighbor_scores'), neighbor_scores)
+        with open(os.path.join(version_dir, 'fingerprint.txt'), 'w') as f:
+            f.write(catalog_fingerprint(products))
+
+# Map the artifacts of one version read-only, pages are only read in as rows are used.
+# The stored row order must match the catalog, so matrix rows and catalog rows line up.
+def load_similarity_artifacts(products, version_dir):
+    # Compared by value: the stored array is numpy unicode/object while the catalog
+    # column may be Arrow-backed, and Index.equals also compares dtypes
+    stored = np.load(artifact_path(version_dir, 'productnos'), allow_pickle=True)
+    if not np.array_equal(stored.astype(object), products['productno'].to_numpy(dtype=object)):
+        raise ValueError(f"Similarity artifacts in {CBF_ARTIFACTS_DIR} do not match the product catalog, delete them to rebuild.")
+    tfidf_matrix = sp.csr_matrix(
+        (
+            np.load(artifact_path(version_dir, 'tfidf_data'), mmap_mode='r'),
+            np.load(artifact_path(version_dir, 'tfidf_indices'), mmap_mode='r'),
+            np.load(artifact_path(version_dir, 'tfidf_indptr'), mmap_mode='r'),
+        ),
+        shape=tuple(np.load(artifact_path(version_dir, 'tfidf_shape'))),
+        copy=False,
+    )
+    product_index = build_product_index(products['productno'])
+    if tfidf_matrix.shape[0] != len(product_index):
+        raise ValueError(f"Similarity artifacts in {CBF_ARTIFACTS_DIR} have {tfidf_matrix.shape[0]} rows for {len(product_index)} products.")
+    if not CBF_NEIGHBORS:
+        similarity = SparseSimilarity(tfidf_matrix)
+    else:
+        similarity = SparseSimilarity(
+            tfidf_matrix,
+            np.load(artifact_path(version_dir, 'neighbor_indices'), mmap_mode='r'),
+            np.load(artifact_path(version_dir, 'neighbor_scores'), mmap_mode='r'),
+        )
+    similarity.product_index = product_index
+    return similarity
+
+# Similarity over the products in catalog order, shared across sessions.
+# Artifacts are rebuilt when the catalog they were built for has changed, by one
+# process at a time; the others wait and then map the version it wrote.
+@st.cache_resource
+def get_similarity(products):
+    products = pd.DataFrame({
+        'productno': products['productno'],
+        'description': products['description'].fillna('').astype(str),
+    })
+    build_product_index(products['productno'])
+    fingerprint = catalog_fingerprint(products)
+    version_dir = current_version(CBF_ARTIFACTS_DIR)
+    if read_fingerprint(version_dir) != fingerprint:
+        with exclusive_lock(CBF_ARTIFACTS_DIR):
+            if read_fingerprint(current_version(CBF_ARTIFACTS_DIR)) != fingerprint:
+                save_similarity_artifacts(products)
+            version_dir = current_version(CBF_ARTIFACTS_DIR)
+    return load_similarity_artifacts(products, version_dir)
+
+# LSH index over the catalog's TF-IDF vectors, see utils.ann for the recall/latency settings
+@st.cache_resource
+def get_ann_index(products):
+    similarity = get_similarity(products)
+    index = LSHIndex(similarity.tfidf_matrix, n_tables=ANN_TABLES, n_bits=ANN_BITS, probes=ANN_PROBES)
+    index.product_index = similarity.product_index
+    return index
+
+def get_default_similarity(df):
+    if CBF_ANN:
+        return get_ann_index(df[['productno', 'description']])
+    return get_similarity(df[['productno', 'description']])
+
+# Most similar rows for each of rows, from an ANN index when given one
+def similar_rows(cosine_sim, rows, k):
+    if isinstance(cosine_sim, LSHIndex):
+        return cosine_sim.nearest(rows, k=k)
+    return top_k_similar(cosine_sim[rows], rows, k=k)
+
+# Matrix rows by productno. A plain matrix without an index is assumed to follow the catalog order.
+def get_product_index(cosine_sim, df):
+    product_index = getattr(cosine_sim, 'product_index', None)
+    if product_index is None:
+        product_index = build_product_index(df['productno'])
+    return product_index
+
+# Re-rank similar products by purchase count and sales margin
+def rank_recommendations(product_indices, df):
     # Include purchase count and sales margin for ranking
     recommendations = df.iloc[product_indices].copy()
     
@@ -32,4 +215,36 @@ def get_recommendations(product_id, df, cosine_sim=cosine_sim):
     
     recommendations = recommendations.sort_values(by='score', ascending=False)
     
-    return recommendations
\ No newline at end of file
+    return recommendations
+
+def get_recommendations(product_id, df, cosine_sim=None, top_n=10):
+    if cosine_sim is None:
+        cosine_sim = get_default_similarity(df)
+    try:
+        idx = get_product_index(cosine_sim, df).get_loc(product_id)
+    except KeyError:
+        print(f"Product with ID {product_id} not found in the dataset.")
+        return pd.DataFrame()
+
+    product_indices = similar_rows(cosine_sim, idx, top_n)[0]
+    return rank_recommendations(product_indices, df)
+
+# Recommendations for many products at once, as {product_id: recommendations}.
+# Similarity rows are ranked in vectorized top-k passes of batch_size rows, so at
+# most batch_size x catalog similarities are held at once.
+def get_batch_recommendations(product_ids, df, cosine_sim=None, top_n=10, batch_size=512):
+    if cosine_sim is None:
+        cosine_sim = get_default_similarity(df)
+    product_ids = pd.unique(pd.Series(product_ids))
+    rows = get_product_index(cosine_sim, df).get_indexer(product_ids)
+    missing = product_ids[rows < 0]
+    if len(missing):
+        print(f"Products with IDs {missing.tolist()} not found in the dataset.")
+    product_ids, rows = product_ids[rows >= 0], rows[rows >= 0]
+    if not len(rows):
+        return {}
+
+    top = []
+    for start in range(0, len(rows), batch_size):
+        top.extend(similar_rows(cosine_sim, rows[start:start + batch_size], top_n))
+    return {product_id: rank_recommendations(product_indices, df) for product_id, product_indices in zip(product_ids, top)}
@@ -0,0 +1,104 @@
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+from utils.customer_metrics import refresh_customer_metrics, load_customer_metrics
+from utils.dashboard_queries import (
+    get_top_10_items,
+    get_credit_account_most_purchased,
+    get_items_purchased_less_than_20,
+    get_least_purchased_items,
+)
+from utils.sales_cube import refresh_sales_cube
+from utils.recommendations import refresh_customer_recommendations, load_customer_recommendations
+from utils.collaborative import train_collaborative
+
+# How often the datasets are rebuilt. Keep it below CACHE_TTL so cached results never expire before they are replaced.
+PREWARM_INTERVAL = int(st.secrets.get('PREWARM_INTERVAL', 1800))  # Seconds
+
+# Held by the one process that rebuilds the files shared by every app process
+PREWARM_LOCK_PATH = st.secrets.get('PREWARM_LOCK_PATH', 'data/prewarm.lock')
+
+# Build time, last refresh and last error of every dataset, kept at module level like CACHE_STATS
+PREWARM_STATUS = {}
+PREWARM_LOCK = {'file': None}
+
+# The first process to take PREWARM_LOCK_PATH keeps it for its lifetime and
+# rebuilds the shared files; the lock is released when that process exits, and
+# another one takes over on its next round
+def holds_prewarm_lock():
+    if PREWARM_LOCK['file'] is None:
+        os.makedirs(os.path.dirname(PREWARM_LOCK_PATH) or '.', exist_ok=True)
+        lock_file = open(PREWARM_LOCK_PATH, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        PREWARM_LOCK['file'] = lock_file
+    return True
+
+# The customer metrics snapshot backs get_all_customer_data and the three
+# customer-based Product Analysis tables. Every process then loads the new
+# snapshot, replacing its cached copy only once it is read.
+def refresh_customer_metrics_cache():
+    if holds_prewarm_lock():
+        refresh_customer_metrics()
+    load_customer_metrics()
+
+# Rebuilt once a day (RECOMMENDATIONS_TTL) rather than on every round
+def refresh_customer_recommendations_cache():
+    if holds_prewarm_lock():
+        refresh_customer_recommendations()
+    load_customer_recommendations()
+
+# Folds the transactions since the last round into the collaborative model;
+# serving picks the new version up once get_collaborative_similarity expires (CF_MODEL_TTL)
+def train_collaborative_model():
+    if holds_prewarm_lock():
+        train_collaborative()
+
+PREWARM_DATASETS = {
+    'Customer metrics': refresh_customer_metrics_cache,
+    'Sales cube': refresh_sales_cube,
+    'Customer recommendations': refresh_customer_recommendations_cache,
+    'Collaborative model': train_collaborative_model,
+    'Top 10 items': get_top_10_items.refresh,
+    'Credit account most purchased': get_credit_account_most_purchased.refresh,
+    'Items purchased less than 20 times': get_items_purchased_less_than_20.refresh,
+    'Least purchased items': get_least_purchased_items.refresh,
+}
+
+# Rebuild every dataset once, in order, recording how long each took
+def prewarm_once(datasets=PREWARM_DATASETS):
+    for name, refresh in datasets.items():
+        status = PREWARM_STATUS.setdefault(name, {'build_seconds': None, 'last_refreshed': None, 'error': None})
+        start = time.perf_counter()
+        try:
+            refresh()
+        except Exception as e:
+            # Keep serving the previous data and try again on the next round
+            print(f"{datetime.now()}: Prewarming {name} failed: {e}")
+            status['error'] = str(e)
+            continue
+        status.update(build_seconds=time.perf_counter() - start, last_refreshed=datetime.now(), error=None)
+        print(f"{datetime.now()}: Prewarmed {name} in {status['build_seconds']:.2f}s")
+
+def prewarm_loop(interval):
+    while True:
+        prewarm_once()
+        time.sleep(interval)
+
+# Start the background refresh once per process; every page calls this so the
+# first script run after a deploy starts it, whichever page is opened
+@st.cache_resource
+def start_prewarm(interval=PREWARM_INTERVAL):
+    thread = threading.Thread(target=prewarm_loop, args=(interval,), name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+def prewarm_status():
+    return pd.DataFrame.from_dict(PREWARM_STATUS, orient='index').rename_axis('dataset').reset_index()
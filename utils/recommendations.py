@@ -0,0 +1,93 @@
+import os
+import time
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+from utils.database import fetch_data
+from utils.customer_metrics import load_customer_metrics
+from utils.models import get_batch_recommendations
+
+# Where the per-customer recommendation table is kept and how often it is rebuilt.
+# It is built by the prewarm scheduler or `python -m utils.recommendations`, never on a user's request.
+RECOMMENDATIONS_PATH = st.secrets.get('RECOMMENDATIONS_PATH', 'data/recommendations.parquet')
+RECOMMENDATIONS_TTL = int(st.secrets.get('RECOMMENDATIONS_TTL', 86400))  # Seconds
+
+PRODUCTS_QUERY = """
+    SELECT
+    p.productno,
+    p.description,
+    p.saleprice,
+    p.buyprice,
+    COUNT(td.productno) AS purchase_count
+    FROM
+    product p
+    LEFT JOIN transactiondetails td ON p.productno = td.productno
+    GROUP BY
+    p.productno,
+    p.description,
+    p.saleprice,
+    p.buyprice
+    ORDER BY
+    p.productno;
+"""
+
+def fetch_products():
+    return fetch_data(PRODUCTS_QUERY)
+
+# Recommendations for every customer in one pass: each customer's top product
+# comes from the customer metrics snapshot, and the recommendations for all of
+# those products are ranked together. One row per customer and recommendation.
+def build_customer_recommendations(top_n=10):
+    print(f"{datetime.now()}: Building customer recommendations")
+    products = fetch_products()
+    customers = load_customer_metrics()[['phone', 'top_productno', 'most_purchased_item']]
+    customers = customers.dropna(subset=['top_productno']).drop_duplicates('phone')
+    customers['top_productno'] = customers['top_productno'].astype(products['productno'].dtype)
+
+    recommendations = get_batch_recommendations(customers['top_productno'].unique(), products, top_n=top_n)
+    columns = ['top_productno', 'rank', 'productno', 'description', 'saleprice', 'score']
+    if recommendations:
+        by_product = pd.concat(
+            [
+                recs.assign(top_productno=product_id, rank=range(1, len(recs) + 1))
+                for product_id, recs in recommendations.items()
+            ],
+            ignore_index=True,
+        )[columns]
+    else:
+        by_product = pd.DataFrame(columns=columns)
+    df = customers.merge(by_product, on='top_productno').sort_values(['phone', 'rank']).reset_index(drop=True)
+
+    os.makedirs(os.path.dirname(RECOMMENDATIONS_PATH) or '.', exist_ok=True)
+    df.to_parquet(f"{RECOMMENDATIONS_PATH}.tmp", index=False)
+    os.replace(f"{RECOMMENDATIONS_PATH}.tmp", RECOMMENDATIONS_PATH)
+    print(f"{datetime.now()}: Built {len(df)} recommendations for {df['phone'].nunique()} customers")
+    return df
+
+# Rebuild the table once it is older than max_age seconds
+def refresh_customer_recommendations(max_age=RECOMMENDATIONS_TTL):
+    if os.path.exists(RECOMMENDATIONS_PATH) and time.time() - os.path.getmtime(RECOMMENDATIONS_PATH) < max_age:
+        return
+    build_customer_recommendations()
+
+# Cached per version of the file, so a rebuilt table replaces the old one without a cold cache
+@st.cache_data(max_entries=2)
+def read_customer_recommendations(mtime):
+    return pd.read_parquet(RECOMMENDATIONS_PATH)
+
+# The latest built table, or None if it has not been built yet
+def load_customer_recommendations():
+    if not os.path.exists(RECOMMENDATIONS_PATH):
+        return None
+    return read_customer_recommendations(os.path.getmtime(RECOMMENDATIONS_PATH))
+
+# Empty when the table has not been built yet or the customer is not in it,
+# callers then compute recommendations live
+def get_customer_recommendations(phone):
+    df = load_customer_recommendations()
+    if df is None:
+        return pd.DataFrame()
+    return df[df['phone'] == phone]
+
+if __name__ == "__main__":
+    build_customer_recommendations()
@@ -0,0 +1,94 @@
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import streamlit as st
+from utils.database import fetch_data
+
+# How long the cube is kept before it is rebuilt from the database
+SALES_CUBE_TTL = int(st.secrets.get('SALES_CUBE_TTL', 3600))  # Seconds
+
+SALES_CUBE_QUERY = """
+SELECT
+    date_trunc('day', datein) AS day,
+    custid,
+    SUM(amount) AS amount
+FROM
+    public.payment
+WHERE
+    datein >= '2019-01-01'
+GROUP BY
+    day, custid;
+"""
+
+# Daily payment totals held as a days x customers array, so any date window and
+# set of excluded customers can be answered with slices instead of re-aggregating.
+# A customer pays on only a few days, so the array is a sparse CSC matrix that
+# stores the days with payments only and slices customers (columns) cheaply.
+#   days: DatetimeIndex of every day between the first and last payment, empty without payments
+#   customer_ids: sorted customer ids, one per column of values
+#   values: amount paid per day (row) and customer (column)
+#   daily_totals: amount paid per day by everyone, including payments without a customer
+def build_sales_cube():
+    print(f"{datetime.now()}: Building sales cube")
+    df = fetch_data(SALES_CUBE_QUERY)
+    df['day'] = pd.to_datetime(df['day'])
+    if df.empty:
+        days = pd.DatetimeIndex([], name='datein')
+    else:
+        days = pd.date_range(df['day'].min(), df['day'].max(), freq='D', name='datein')
+    daily_totals = df.groupby('day')['amount'].sum().reindex(days, fill_value=0).to_numpy(dtype='float64')
+
+    known = df[df['custid'].notna()]
+    customer_ids = np.unique(known['custid'].to_numpy(dtype='int64'))
+    rows = days.get_indexer(known['day'])
+    columns = np.searchsorted(customer_ids, known['custid'].to_numpy(dtype='int64'))
+    values = sparse.csc_matrix(
+        (known['amount'].to_numpy(dtype='float64'), (rows, columns)),
+        shape=(len(days), len(customer_ids)),
+    )
+    print(f"{datetime.now()}: Sales cube built with {len(days)} days and {len(customer_ids)} customers")
+    return {'days': days, 'customer_ids': customer_ids, 'values': values, 'daily_totals': daily_totals}
+
+# The latest cube, shared across sessions. It is built by the prewarm thread, only
+# read after it is built and replaced whole, so readers keep the previous cube
+# while a new one is built.
+SALES_CUBE = {'latest': None}
+SALES_CUBE_LOCK = threading.Lock()
+
+# One build at a time
+def refresh_sales_cube():
+    with SALES_CUBE_LOCK:
+        cube = build_sales_cube()
+        cube['built_at'] = time.monotonic()
+        SALES_CUBE['latest'] = cube
+        return cube
+
+def is_fresh(cube):
+    return cube is not None and time.monotonic() - cube['built_at'] < SALES_CUBE_TTL
+
+# The cube if a fresh one is built, without waiting for a build; None otherwise
+def peek_sales_cube():
+    cube = SALES_CUBE['latest']
+    return cube if is_fresh(cube) else None
+
+# Sales totals resampled to freq ('D', 'W-MON', 'MS', ...) for the days from
+# start_date to end_date inclusive, leaving out the excluded customers
+def query_sales_cube(cube, freq, start_date, end_date, excluded_customer_ids=()):
+    days = cube['days']
+    start = days.searchsorted(pd.Timestamp(start_date), side='left')
+    end = days.searchsorted(pd.Timestamp(end_date), side='right')
+    totals = cube['daily_totals'][start:end]
+
+    excluded = np.asarray(excluded_customer_ids, dtype='int64')
+    excluded = excluded[np.isin(excluded, cube['customer_ids'])]
+    if len(excluded):
+        columns = np.searchsorted(cube['customer_ids'], excluded)
+        totals = totals - np.asarray(cube['values'][:, columns][start:end].sum(axis=1)).ravel()
+
+    df = pd.DataFrame({'amount': totals}, index=days[start:end])
+    if freq == 'D':
+        return df
+    return df.resample(freq).sum()
@@ -0,0 +1,43 @@
+import fcntl
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# Files that must be read together (a model's arrays, their index and watermark)
+# are written as one version: a fresh directory that a `current` symlink in
+# base_dir is switched to with a single rename. A reader that resolves the link
+# once sees one complete version, never a mix of old and new files.
+
+def current_version(base_dir):
+    link = os.path.join(base_dir, 'current')
+    return os.path.realpath(link) if os.path.exists(link) else None
+
+# Yields a new directory to write the files into; it becomes current once the
+# block completes, and is discarded if the block fails. The previous version is
+# kept for readers that resolved the link just before the switch, older ones are dropped.
+@contextmanager
+def new_version(base_dir):
+    os.makedirs(base_dir, exist_ok=True)
+    previous = current_version(base_dir)
+    version_dir = tempfile.mkdtemp(prefix='version-', dir=base_dir)
+    try:
+        yield version_dir
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    link = os.path.join(base_dir, f"current.{os.getpid()}.tmp")
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, os.path.join(base_dir, 'current'))
+    keep = {os.path.basename(version_dir), os.path.basename(previous or '')}
+    for name in os.listdir(base_dir):
+        if name.startswith('version-') and name not in keep:
+            shutil.rmtree(os.path.join(base_dir, name), ignore_errors=True)
+
+# Serializes writers of base_dir across threads and processes on this host
+@contextmanager
+def exclusive_lock(base_dir):
+    os.makedirs(base_dir, exist_ok=True)
+    with open(os.path.join(base_dir, 'refresh.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield